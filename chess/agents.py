@@ -1,31 +1,299 @@
 import abc
+import multiprocessing
 import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple, List
 
 import time
 
-from chess.state import State, GameResult
-
-
-def _popcount(n):
-    n = (n & 0x5555555555555555) + ((n & 0xAAAAAAAAAAAAAAAA) >> 1)
-    n = (n & 0x3333333333333333) + ((n & 0xCCCCCCCCCCCCCCCC) >> 2)
-    n = (n & 0x0F0F0F0F0F0F0F0F) + ((n & 0xF0F0F0F0F0F0F0F0) >> 4)
-    n = (n & 0x00FF00FF00FF00FF) + ((n & 0xFF00FF00FF00FF00) >> 8)
-    n = (n & 0x0000FFFF0000FFFF) + ((n & 0xFFFF0000FFFF0000) >> 16)
-    n = (n & 0x00000000FFFFFFFF) + ((n & 0xFFFFFFFF00000000) >> 32)
-    return n
+from chess.state import State, GameResult, PIECE_VALUES, RANKS, \
+    MATERIAL_VALUES
+from chess.transposition import TranspositionTable, TWO_TIER, EXACT, \
+    LOWER, UPPER
 
 
 class Agent(abc.ABC):
+    """
+    Chooses moves. The server builds agents from --kwarg options, so
+    constructor arguments may be strings
+    """
+    # Optional chess.instrumentation.SearchStats the search reports to
+    stats = None
+
     @abc.abstractmethod
     def select_move(self, state: 'State') -> Tuple[int, int]:
         pass
 
 
-class MinimaxAgent(Agent):
-    def __init__(self):
+# Score for giving mate at the root, less one for every ply until the mate so
+# faster mates score higher. Anything past MATE_BOUND is a mate score
+MATE_SCORE = 1000000
+MATE_BOUND = MATE_SCORE - 1000
+
+
+def _to_table(score: float, ply: int) -> float:
+    """
+    Mate scores count plies from the root, but a stored position can be
+    reached at any ply, so they are stored counting from the position
+    """
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def _from_table(score: float, ply: int) -> float:
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class _SearchStopped(Exception):
+    """
+    Raised inside the search when the time or node budget runs out
+    """
+
+
+def flag(value) -> bool:
+    """
+    Read a switch that may come from the server command line as a string
+    """
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def optional(value, convert=float):
+    """
+    Read a number that may be None, which comes from the server command line
+    as the string 'None' or an empty string
+    """
+    if value is None or isinstance(value, str) and \
+            value.strip().lower() in ('', 'none'):
+        return None
+    return convert(value)
+
+
+class PoolAgent(Agent):
+    """
+    Agent running part of its search in a pool of worker processes. The pool
+    is started on the first search and kept for later ones, call close to
+    stop it. Each worker gets a copy of the agent, without the pool or the
+    stats, set up by init_worker
+    """
+    workers = 1
+    _pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['stats'] = None
+        return state
+
+    def _start_pool(self, *args) -> None:
+        """
+        Start the worker processes, passing args to each copy's init_worker
+        """
+        self._pool = ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(self,) + args)
+
+    def init_worker(self, *args) -> None:
+        """
+        Set up the copy of the agent in a worker process
+        """
+
+    def close(self) -> None:
+        """
+        Stop the worker processes, if any were started
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# The copy of the agent in a worker process, set up once by _init_worker
+_worker_agent = None
+
+
+def _init_worker(agent: PoolAgent, *args) -> None:
+    global _worker_agent
+    agent.init_worker(*args)
+    _worker_agent = agent
+
+
+def worker_agent() -> PoolAgent:
+    """
+    The copy of the agent in this worker process
+    """
+    return _worker_agent
+
+
+class MinimaxAgent(PoolAgent):
+    # What winning each piece is worth on the heuristic's scale, used to skip
+    # captures in the quiescence search
+    capture_values = PIECE_VALUES
+
+    def __init__(self, tt_mb: float = 16, tt_policy: str = TWO_TIER,
+                 max_time: float = None, max_nodes: int = None,
+                 use_mvv_lva: bool = True, use_killers: bool = True,
+                 use_history: bool = True, use_quiescence: bool = True,
+                 quiescence_checks: bool = False, quiescence_ply: int = 8,
+                 delta_margin: float = 2, use_pvs: bool = True,
+                 aspiration_window: float = 1, workers: int = 1,
+                 use_null_move: bool = True, null_move_reduction: int = 2,
+                 null_move_depth: int = 3, use_lmr: bool = True,
+                 lmr_reduction: int = 1, lmr_depth: int = 3,
+                 lmr_moves: int = 3, max_ponder_time: float = 60):
+        """
+        Params:
+        ------
+        tt_mb: float
+            Memory cap of the transposition table in MB, 0 to search without
+            one
+        tt_policy: str
+            Replacement policy of the transposition table, one of
+            chess.transposition.POLICIES
+        max_time: float
+            Seconds select_move may take, or None for no limit
+        max_nodes: int
+            Nodes select_move may search, or None for no limit
+        use_mvv_lva: bool
+            Try captures of the most valuable victim with the least valuable
+            attacker first
+        use_killers: bool
+            Try the last two quiet moves that caused a cutoff at the same ply
+            before other quiet moves
+        use_history: bool
+            Order quiet moves by how often they caused cutoffs, weighted by
+            depth
+        use_quiescence: bool
+            Keep searching captures and promotions past max_depth until the
+            position is quiet, instead of scoring it mid exchange
+        quiescence_checks: bool
+            Also search quiet moves that give check on the first ply of the
+            quiescence search
+        quiescence_ply: int
+            Deepest the quiescence search goes past max_depth
+        delta_margin: float
+            Skip captures in the quiescence search that can't bring the score
+            back up to alpha even with this much to spare, in pawns. None to
+            search every capture
+        use_pvs: bool
+            Search every move after the first with a null window, only
+            searching it again with the full window if it turns out better
+        aspiration_window: float
+            Start each iteration with a window this far either side of the
+            previous iteration's score, in pawns, widening it if the score
+            falls outside. None to always use the full window
+        workers: int
+            Processes to split the root moves between, see PoolAgent
+        use_null_move: bool
+            Let the side to move pass and search the result shallower, away
+            from the principal variation. If passing still scores at least
+            beta, so will a real move, and the node is cut off. Skipped in
+            check and when the side to move only has pawns, where passing
+            could be the better option
+        null_move_reduction: int
+            How much shallower than a real move the null move is searched
+        null_move_depth: int
+            Least remaining depth to try a null move at
+        use_lmr: bool
+            Search quiet moves that come late in the move order shallower,
+            searching them again to full depth if they beat alpha
+        lmr_reduction: int
+            Plies a late move's search is reduced by
+        lmr_depth: int
+            Least remaining depth to reduce moves at
+        lmr_moves: int
+            Moves searched to full depth at a node before reducing the rest
+        max_ponder_time: float
+            Seconds a search on the opponent's time may run before it stops
+            and waits for their move, or None to run until max_depth. The
+            node budget doesn't apply to it
+        """
         self.whose_turn = None
+        tt_mb = float(tt_mb)
+        self._table_args = (tt_mb, tt_policy)
+        self.table = TranspositionTable(tt_mb, tt_policy) if tt_mb > 0 \
+            else None
+        self.max_time = optional(max_time)
+        self.max_nodes = optional(max_nodes, int)
+        self.use_mvv_lva = flag(use_mvv_lva)
+        self.use_killers = flag(use_killers)
+        self.use_history = flag(use_history)
+        self.use_quiescence = flag(use_quiescence)
+        self.quiescence_checks = flag(quiescence_checks)
+        self.quiescence_ply = int(quiescence_ply)
+        # Both are given in pawns and kept on the heuristic's scale
+        pawn = self.capture_values[0]
+        self.delta_margin = optional(delta_margin)
+        if self.delta_margin is not None:
+            self.delta_margin *= pawn
+        self.use_pvs = flag(use_pvs)
+        self.aspiration_window = optional(aspiration_window)
+        if self.aspiration_window is not None:
+            self.aspiration_window *= pawn
+        # Best line found by the last finished iteration and its score, for
+        # the side to move at the root
+        self.principal_variation = []
+        self.score = None
+        self.nodes = 0
+        self.completed_depth = 0
+        # Killer moves by ply from the root, history scores by side to move
+        self.killers = []
+        self.history = ({}, {})
+        self.workers = int(workers)
+        self.use_null_move = flag(use_null_move)
+        self.null_move_reduction = int(null_move_reduction)
+        self.null_move_depth = int(null_move_depth)
+        self.use_lmr = flag(use_lmr)
+        self.lmr_reduction = int(lmr_reduction)
+        self.lmr_depth = int(lmr_depth)
+        self.lmr_moves = int(lmr_moves)
+        self.max_ponder_time = optional(max_ponder_time)
+        self._pool = None
+        self._shared_alpha = None
+        self._shared_nodes = None
+        # In a worker, the nodes of every job of the search, counted against
+        # max_nodes, and how many of the current job's have been added
+        self._node_counter = None
+        self._counted_nodes = 0
+        self._search_id = 0
+        # Set from another thread to stop a search, and while searching on
+        # the opponent's time, with no budget
+        self._stop = False
+        self._pondering = False
+        self._ponder_thread = None
+        self._ponder_state = None
+        self._ponder_move = None
+
+    def __getstate__(self):
+        # Workers get a table of their own, and nothing of the parent's
+        # search on the opponent's time
+        state = super().__getstate__()
+        state['_shared_alpha'] = state['_shared_nodes'] = None
+        state['_ponder_thread'] = None
+        state['_stop'] = state['_pondering'] = False
+        if self.table is not None:
+            state['table'] = TranspositionTable(*self._table_args)
+        return state
+
+    def init_worker(self, shared_alpha, shared_nodes) -> None:
+        self._shared_alpha = shared_alpha
+        self._node_counter = shared_nodes
+
+    def close(self) -> None:
+        """
+        Stop the worker processes, if any were started, and any search on
+        the opponent's time
+        """
+        self.stop_pondering()
+        super().close()
+        self._shared_alpha = self._shared_nodes = None
 
     @abc.abstractmethod
     def heuristic(self, state: 'State') -> float:
@@ -37,53 +305,584 @@ class MinimaxAgent(Agent):
         pass
 
     def select_move(self, state: 'State') -> Tuple[int, int]:
-        self.whose_turn = state.white_turn
-        self._alpha_beta(state, self.max_depth, -float('inf'), float('inf'),
-                         True)
-        return self.optimal_child.prev_move
+        """
+        Search one ply deeper at a time up to max_depth, each iteration
+        trying the previous one's best move first, in a window around its
+        score. When the time or node budget runs out the unfinished iteration
+        is dropped, and the move of the last finished one returned
+        """
+        self.stop_pondering()
+        self._stop = False
+        self._pondering = False
+        return self._deepen(state)
 
-    def _alpha_beta(self, state: 'State', depth: int, alpha: float, beta: float,
-                    maxer: bool) -> float:
-        result = state.is_terminal()
-        if result == GameResult.P1_WINS:
-            # print(state)
-            # print()
-            if self.whose_turn:
-                return 10000 * depth
-            else:
-                return -10000 * depth
-        elif result == GameResult.P2_WINS:
-            if self.whose_turn:
-                return -10000 * depth
+    def ponder(self, state: 'State') -> bool:
+        """
+        Search on the opponent's time: guess their reply from the principal
+        variation of the last search, and search the position after it in a
+        background thread until stop_pondering is called, or for at most
+        max_ponder_time
+        Params:
+        ------
+        state: State
+            Position after the move select_move returned, opponent to move
+        Returns:
+        ------
+        bool:
+            Whether there was a reply to ponder on
+        """
+        self.stop_pondering()
+        line = self.principal_variation
+        if len(line) < 2 or line[0] != state.prev_move or \
+                line[1] not in state.list_legal_moves():
+            return False
+        state = state.get_child(*line[1])
+        if state.is_terminal():
+            return False
+        self._stop = False
+        self._pondering = True
+        self._ponder_state = state
+        self._ponder_move = None
+        self._ponder_thread = threading.Thread(target=self._ponder,
+                                               args=(state,), daemon=True)
+        self._ponder_thread.start()
+        return True
+
+    def _ponder(self, state: 'State') -> None:
+        self._ponder_move = self._deepen(state)
+
+    def stop_pondering(self, state: 'State' = None) -> Tuple[int, int]:
+        """
+        End the search started by ponder. If the opponent played the
+        expected reply, it goes on as a normal search, with the time budget
+        counted from now and the nodes searched so far counted against the
+        node budget, and its move is returned. Otherwise it is stopped
+        and thrown away, although its table entries are kept
+        Params:
+        ------
+        state: State
+            Position the opponent's move led to, or None to just stop
+        Returns:
+        ------
+        Tuple[int, int]:
+            Move to play in state, or None if it wasn't the pondered position
+        """
+        thread = self._ponder_thread
+        if thread is None:
+            return None
+        hit = state is not None and state == self._ponder_state
+        if hit:
+            self._deadline = None if self.max_time is None else \
+                time.time() + self.max_time
+            self._pondering = False
+        else:
+            self._stop = True
+        thread.join()
+        self._ponder_thread = None
+        self._ponder_state = None
+        self._stop = self._pondering = False
+        return self._ponder_move if hit else None
+
+    def _deepen(self, state: 'State') -> Tuple[int, int]:
+        """
+        Iterative deepening from state, shared by select_move and ponder
+        """
+        self._start_search(state.white_turn)
+        stats = self.stats
+        if stats is not None:
+            stats.start(self.table)
+        self._search_id += 1
+        self.completed_depth = 0
+        self.principal_variation = []
+        self.score = None
+        limit = self.max_ponder_time if self._pondering else self.max_time
+        self._deadline = None if limit is None else time.time() + limit
+        # The first iteration always finishes, so there is a move to return
+        self._next_check = float('inf')
+        best_move = None
+        # Search a private copy, which is updated in place with make_move
+        state = state.copy()
+        for depth in range(1, self.max_depth + 1):
+            # Principal variation found below each ply, longest at ply 0
+            self._pv = [[] for _ in range(depth + 1)]
+            try:
+                if self.workers > 1 and depth > 1 and not self._pondering:
+                    score = self._parallel_root(state, depth)
+                else:
+                    score = self._aspiration(state, depth, self.score)
+            except _SearchStopped:
+                break
+            best_move = self.optimal_move
+            self.principal_variation = self._pv[0]
+            self.score = score
+            self.completed_depth = depth
+            self._next_check = self.nodes
+            if stats is not None:
+                stats.iteration(depth, self.nodes)
+        self.optimal_move = best_move
+        # A ponder hit goes on as a normal search the user is waiting for
+        if stats is not None:
+            stats.finish(self, best_move, self.nodes, score=self.score,
+                         ponder=self._pondering)
+        return best_move
+
+    def _start_search(self, white_turn: bool) -> None:
+        """
+        Get ready to search a new position for the given side
+        """
+        if self.table is not None:
+            # Draws are scored against the searching side, so stored scores
+            # only hold for one side
+            if self.whose_turn != white_turn:
+                self.table.clear()
+            self.table.new_search()
+        self.whose_turn = white_turn
+        self.optimal_move = None
+        self.nodes = 0
+        # Plies are counted from the new root, so old killers don't apply.
+        # History is kept but ages, so recent cutoffs count for more
+        self.killers = []
+        for history in self.history:
+            for move in history:
+                history[move] //= 2
+
+    def _parallel_root(self, state: 'State', depth: int) -> float:
+        """
+        Search the first root move here, then split the others between the
+        worker processes. Each worker first checks its move against the best
+        score so far with a null window, which is shared between processes
+        and raised as better moves are found, and only searches it fully if
+        it is better
+        """
+        moves = list(state.staged_moves(
+            self.optimal_move, (),
+            self.history[0 if state.white_turn else 1]
+            if self.use_history else None,
+            self.use_mvv_lva))
+        if len(moves) < 2:
+            return self._alpha_beta(state, depth, -float('inf'), float('inf'),
+                                    0)
+        if self._pool is None:
+            self._shared_alpha = multiprocessing.Value('d', 0.0)
+            self._shared_nodes = multiprocessing.Value('q', 0)
+            self._start_pool(self._shared_alpha, self._shared_nodes)
+
+        move = moves[0]
+        undo = state.make_move(move)
+        best = -self._alpha_beta(state, depth - 1, -float('inf'),
+                                 float('inf'), 1)
+        state.unmake_move(undo)
+        self.optimal_move = move
+        line = [move] + self._pv[1]
+        self._shared_alpha.value = best
+        # The jobs count their nodes together, so they share what is left of
+        # the budget however many there are
+        self._shared_nodes.value = self.nodes
+
+        futures = [self._pool.submit(
+            _search_root_move, self._search_id, self.whose_turn, state, move,
+            depth, self._deadline, self.max_nodes) for move in moves[1:]]
+        stopped = False
+        for future in futures:
+            move, score, exact, pv, nodes = future.result()
+            self.nodes += nodes
+            if score is None:
+                stopped = True
+            # A move that failed low only has a bound, which can equal the
+            # score of the move that raised the shared bound it was searched
+            # against
+            elif exact and score > best:
+                best = score
+                self.optimal_move = move
+                line = [move] + pv
+        if stopped:
+            raise _SearchStopped()
+        self._pv[0] = line
+        return best
+
+    def _aspiration(self, state: 'State', depth: int, guess: float) -> float:
+        """
+        Search the root in a narrow window around the expected score, which
+        cuts off more, and widen it for another search when the score falls
+        outside
+        """
+        window = self.aspiration_window
+        if guess is None or window is None or abs(guess) >= MATE_BOUND:
+            return self._alpha_beta(state, depth, -float('inf'),
+                                    float('inf'), 0)
+        alpha, beta = guess - window, guess + window
+        while True:
+            score = self._alpha_beta(state, depth, alpha, beta, 0)
+            if alpha < score < beta:
+                return score
+            window *= 4
+            if score <= alpha:
+                alpha = score - window
             else:
-                return 10000 * depth
-        elif result == GameResult.DRAW:
-            return -1
-        elif depth == 0:
-            return self.heuristic(state)
-        children = state.get_children()
-        if maxer:
-            v = -float('inf')
-            for child in children:
-                y = self._alpha_beta(child, depth - 1, alpha, beta, False)
-                if y > v and depth == self.max_depth:
-                    # print(child)
-                    # print(child.is_terminal())
-                    self.optimal_child = child
-                v = max(v, y)
-                alpha = max(alpha, v)
-                if beta <= alpha:
-                    break
-            return v
+                beta = score + window
+            if window > 64 * self.aspiration_window:
+                alpha, beta = -float('inf'), float('inf')
+
+    def _check_budget(self) -> None:
+        """
+        Stop the search if it is out of time or nodes, otherwise schedule the
+        next check. The clock is only read every few hundred nodes. Pondering
+        only has the time budget of max_ponder_time, and the jobs of a
+        parallel search count their nodes against one budget
+        """
+        if self._stop:
+            raise _SearchStopped()
+        self._next_check = self.nodes + 256
+        if self._deadline is not None and time.time() >= self._deadline:
+            raise _SearchStopped()
+        if self._pondering or self.max_nodes is None:
+            return
+        nodes = self.nodes if self._node_counter is None \
+            else self._count_shared_nodes()
+        if nodes >= self.max_nodes:
+            raise _SearchStopped()
+        self._next_check = min(self._next_check,
+                               self.nodes + self.max_nodes - nodes)
+
+    def _count_shared_nodes(self) -> int:
+        """
+        Add the nodes searched since the last check to the count of every
+        worker's, in a worker process
+        Returns:
+        ------
+        int:
+            Nodes searched by the whole search so far
+        """
+        counter = self._node_counter
+        with counter.get_lock():
+            counter.value += self.nodes - self._counted_nodes
+            total = counter.value
+        self._counted_nodes = self.nodes
+        return total
+
+    def _evaluate(self, state: 'State') -> float:
+        """
+        The heuristic, which scores for the searching side, turned around to
+        score for the side to move
+        """
+        stats = self.stats
+        if stats is None:
+            score = self.heuristic(state)
+        else:
+            score = stats.evaluate(self.heuristic, state)
+        return score if state.white_turn == self.whose_turn else -score
+
+    def _draw_score(self, state: 'State') -> float:
+        # Slightly worse than even for the searching side, so it plays on
+        return -1 if state.white_turn == self.whose_turn else 1
+
+    def _cutoff(self, state: 'State', move: Tuple[int, int],
+                depth: int, ply: int) -> None:
+        """
+        Remember a quiet move that caused a cutoff, for the killer and history
+        heuristics
+        """
+        if move[1] & (state.black_pos if state.white_turn else
+                      state.white_pos):
+            return
+        if self.use_killers:
+            while len(self.killers) <= ply:
+                self.killers.append([])
+            killers = self.killers[ply]
+            if move not in killers:
+                killers.insert(0, move)
+                del killers[2:]
+        if self.use_history:
+            history = self.history[0 if state.white_turn else 1]
+            history[move] = history.get(move, 0) + depth * depth
+
+    def _capture_gain(self, state: 'State', move: Tuple[int, int]) -> float:
+        """
+        Material a move wins on the capture_values scale, or None if it is a
+        quiet move
+        """
+        piece, target = move
+        if state.white_turn:
+            me, them, them_pos = state.white, state.black, state.black_pos
         else:
-            v = float('inf')
-            for child in children:
-                y = self._alpha_beta(child, depth - 1, alpha, beta, True)
-                v = min(v, y)
-                beta = min(beta, v)
-                if beta <= alpha:
+            me, them, them_pos = state.black, state.white, state.white_pos
+        values = self.capture_values
+        gain = None
+        if target & them_pos:
+            for ix in range(6):
+                if them[ix] & target:
+                    gain = values[ix]
                     break
-            return v
+        if piece & me[0]:
+            if target & (RANKS[0] | RANKS[7]):
+                gain = (gain or 0) + values[4] - values[0]
+            elif gain is None and target not in (
+                    piece << 8, piece >> 8, piece << 16, piece >> 16):
+                gain = values[0]  # en passant
+        return gain
+
+    def _quiesce(self, state: 'State', alpha: float, beta: float, ply: int,
+                 q_ply: int) -> float:
+        """
+        Search only captures and promotions from a leaf of the main search,
+        so it is scored once the exchanges are over. The side to move can
+        always stand pat on the heuristic instead of capturing, except when in
+        check, where every evasion is searched
+        """
+        self.nodes += 1
+        if self.nodes >= self._next_check:
+            self._check_budget()
+        stats = self.stats
+        if stats is not None:
+            stats.node(ply)
+        if state.white_pos == state.white[5] and \
+                state.black_pos == state.black[5]:
+            return self._draw_score(state)
+        in_check = state.in_check
+        if q_ply >= self.quiescence_ply:
+            return self._evaluate(state)
+        if in_check:
+            best = -float('inf')
+            moves = state.staged_moves(mvv_lva=self.use_mvv_lva)
+        else:
+            best = self._evaluate(state)
+            if best >= beta:
+                return best
+            alpha = max(alpha, best)
+            moves = state.staged_moves(
+                mvv_lva=self.use_mvv_lva,
+                quiets=self.quiescence_checks and q_ply == 0)
+        if stats is not None:
+            moves = stats.moves(moves)
+        stand_pat = best
+        margin = self.delta_margin
+        searched = False
+        for move in moves:
+            searched = True
+            if not in_check:
+                gain = self._capture_gain(state, move)
+                if gain is None:
+                    # Quiet moves are only searched if they give check
+                    undo = state.make_move(move)
+                    gives_check = state.in_check
+                    state.unmake_move(undo)
+                    if not gives_check:
+                        continue
+                elif margin is not None and \
+                        stand_pat + gain + margin <= alpha:
+                    continue
+            undo = state.make_move(move)
+            score = -self._quiesce(state, -beta, -alpha, ply + 1, q_ply + 1)
+            state.unmake_move(undo)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        if in_check and not searched:
+            return -MATE_SCORE + ply
+        return best
+
+    def _alpha_beta(self, state: 'State', depth: int, alpha: float, beta: float,
+                    ply: int) -> float:
+        """
+        Negamax principal variation search: scores are for the side to move,
+        and a child's score is the negated score of its parent's opponent
+        Params:
+        ------
+        state: State
+            Position to search, updated in place and restored
+        depth: int
+            Plies left to search before the quiescence search
+        alpha: float
+            Score the side to move already has elsewhere
+        beta: float
+            Score the opponent already has elsewhere, negated
+        ply: int
+            Plies from the root
+        Returns:
+        ------
+        float:
+            The score, exact if it is strictly between alpha and beta,
+            otherwise a bound on the side of the window it fell
+        """
+        self._pv[ply] = []
+        if depth == 0 and self.use_quiescence:
+            return self._quiesce(state, alpha, beta, ply, 0)
+        self.nodes += 1
+        if self.nodes >= self._next_check:
+            self._check_budget()
+        stats = self.stats
+        if stats is not None:
+            stats.node(ply)
+        if state.white_pos == state.white[5] and \
+                state.black_pos == state.black[5]:
+            return self._draw_score(state)
+        if depth == 0:
+            result = state.is_terminal()
+            if not result:
+                return self._evaluate(state)
+            return self._draw_score(state) if result == GameResult.DRAW \
+                else -MATE_SCORE + ply
+
+        # Results from another move order or an earlier search are reused
+        # when they went at least as deep. The root always searches, since it
+        # has to pick the move, starting from the last iteration's choice,
+        # and so do nodes on the principal variation, so it comes out whole
+        table = self.table
+        root = ply == 0
+        pv_node = beta - alpha > 1
+        hash_move = self.optimal_move if root else None
+        alpha_orig = alpha
+        if table is not None:
+            entry = table.probe(state.zobrist)
+            if entry is not None:
+                _, entry_depth, bound, score, move, _ = entry
+                if hash_move is None:
+                    hash_move = move
+                if entry_depth >= depth and not pv_node:
+                    score = _from_table(score, ply)
+                    if bound == EXACT or \
+                            (bound == LOWER and score >= beta) or \
+                            (bound == UPPER and score <= alpha):
+                        return score
+
+        # Null move: if the side to move is still at least at beta after
+        # passing, searched shallower, a real move would be too. A null move
+        # just made leaves no previous move, so two are never made in a row
+        in_check = state.in_check
+        if self.use_null_move and not pv_node and not in_check and \
+                depth >= self.null_move_depth and \
+                state.prev_move is not None and abs(beta) < MATE_BOUND:
+            me = state.white if state.white_turn else state.black
+            if (me[1] | me[2] | me[3] | me[4]) and \
+                    self._evaluate(state) >= beta:
+                undo = state.make_null_move()
+                score = -self._alpha_beta(
+                    state, max(depth - 1 - self.null_move_reduction, 0),
+                    -beta, -beta + 1, ply + 1)
+                state.unmake_null_move(undo)
+                if score >= beta:
+                    return beta if score >= MATE_BOUND else score
+
+        # Moves come out staged, so a cutoff on a capture means the quiet
+        # moves are never generated. Running out of moves without making one
+        # means mate or stalemate
+        killers = self.killers[ply] if ply < len(self.killers) else ()
+        moves = state.staged_moves(
+            hash_move,
+            killers,
+            self.history[0 if state.white_turn else 1]
+            if self.use_history else None,
+            self.use_mvv_lva)
+        if stats is not None:
+            moves = stats.moves(moves)
+        best = -float('inf')
+        best_move = None
+        reduce_late = self.use_lmr and not root and not in_check and \
+            depth >= self.lmr_depth
+        n_moves = 0
+        for move in moves:
+            n_moves += 1
+            # Late quiet moves are searched shallower with a null window,
+            # unless they give check
+            reduction = 0
+            if reduce_late and n_moves > self.lmr_moves and \
+                    move not in killers and \
+                    self._capture_gain(state, move) is None:
+                reduction = min(self.lmr_reduction, depth - 1)
+            undo = state.make_move(move)
+            score = None
+            if reduction and not state.in_check:
+                score = -self._alpha_beta(state, depth - 1 - reduction,
+                                          -alpha - 1, -alpha, ply + 1)
+            if score is None or score > alpha:
+                if best_move is None or not self.use_pvs:
+                    score = -self._alpha_beta(state, depth - 1, -beta,
+                                              -alpha, ply + 1)
+                else:
+                    # Only prove the move is no better than the best so far
+                    score = -self._alpha_beta(state, depth - 1, -alpha - 1,
+                                              -alpha, ply + 1)
+                    if alpha < score < beta:
+                        score = -self._alpha_beta(state, depth - 1, -beta,
+                                                  -alpha, ply + 1)
+            state.unmake_move(undo)
+            if score > best or best_move is None:
+                best = score
+                best_move = move
+                if root:
+                    self.optimal_move = move
+                if score > alpha:
+                    alpha = score
+                    self._pv[ply] = [move] + self._pv[ply + 1]
+                    if alpha >= beta:
+                        self._cutoff(state, move, depth, ply)
+                        if stats is not None:
+                            stats.cutoff(n_moves == 1)
+                        break
+        if best_move is None:
+            return -MATE_SCORE + ply if state.in_check else \
+                self._draw_score(state)
+        if table is not None:
+            if best <= alpha_orig:
+                bound = UPPER
+            elif best >= beta:
+                bound = LOWER
+            else:
+                bound = EXACT
+            table.store(state.zobrist, depth, bound, _to_table(best, ply),
+                        best_move)
+        return best
+
+
+# Search the worker process last started, to reset its agent for a new one
+_worker_search_id = None
+
+
+def _search_root_move(search_id: int, whose_turn: bool, state: 'State',
+                      move: Tuple[int, int], depth: int, deadline: float,
+                      max_nodes: int) -> tuple:
+    """
+    Search one root move in a worker process
+    Returns:
+    ------
+    tuple:
+        The move, its score (None if the budget ran out), whether the score
+        is exact rather than an upper bound because the move failed low
+        against the shared bound, the line after it and the number of nodes
+        searched
+    """
+    global _worker_search_id
+    agent = worker_agent()
+    shared_alpha = agent._shared_alpha
+    if search_id != _worker_search_id:
+        _worker_search_id = search_id
+        agent._start_search(whose_turn)
+    agent.nodes = agent._counted_nodes = 0
+    agent.max_nodes = max_nodes
+    agent._deadline = deadline
+    agent._next_check = 0
+    agent._pv = [[] for _ in range(depth + 1)]
+    state.make_move(move)
+    try:
+        alpha = shared_alpha.value
+        score = -agent._alpha_beta(state, depth - 1, -alpha - 1, -alpha, 1)
+        exact = False
+        if score > alpha:
+            score = -agent._alpha_beta(state, depth - 1, -float('inf'),
+                                       -alpha, 1)
+            exact = score > alpha
+            if exact:
+                with shared_alpha.get_lock():
+                    if score > shared_alpha.value:
+                        shared_alpha.value = score
+    except _SearchStopped:
+        return move, None, False, [], agent.nodes
+    finally:
+        agent._count_shared_nodes()
+    return move, score, exact, agent._pv[1], agent.nodes
 
 
 class SavingAgent(Agent):
@@ -155,27 +954,29 @@ class LearningAgent(Agent):
 
 
 class SampleMinimaxAgent(MinimaxAgent):
-    def __init__(self, max_depth: int = 3):
-        super().__init__()
+    capture_values = MATERIAL_VALUES
+
+    def __init__(self, max_depth: int = 3, **kwargs):
+        """
+        Params:
+        ------
+        max_depth: int
+            Deepest iteration to search
+        kwargs:
+            Search options, see MinimaxAgent
+        """
+        super().__init__(**kwargs)
         self._max_depth = int(max_depth)
 
     @property
     def max_depth(self):
         return self._max_depth
 
-    def piece_value(self, state_tuple):
-        return _popcount(state_tuple[0]) + \
-               3 * (_popcount(state_tuple[1]) + _popcount(state_tuple[2])) + \
-               5 * _popcount(state_tuple[3]) + 12 * _popcount(state_tuple[4])
-
     def heuristic(self, state: 'State'):
-        if state.white_turn:
-            me = state.white
-            them = state.black
-        else:
-            me = state.black
-            them = state.white
-        return self.piece_value(them) - self.piece_value(me)
+        # Material and piece-square score, kept up to date by make_move and
+        # counted for white. Scored for the side searching, whichever side is
+        # to move at the leaf, so results stored at different depths agree
+        return state.psqt if self.whose_turn else -state.psqt
 
 
 class CountingMinimaxAgent(SampleMinimaxAgent):
@@ -193,10 +994,10 @@ class CountingMinimaxAgent(SampleMinimaxAgent):
         return super(CountingMinimaxAgent, self).select_move(state)
 
     def _alpha_beta(self, state: 'State', depth: int, alpha: float, beta: float,
-                    maxer: bool):
+                    ply: int):
         self.n_ab += 1
         return super(CountingMinimaxAgent, self)._alpha_beta(state, depth,
-                                                             alpha, beta, maxer)
+                                                             alpha, beta, ply)
 
     def heuristic(self, state: 'State'):
         self.n_heuristic += 1
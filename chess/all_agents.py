@@ -4,5 +4,7 @@ agent_list = {
     'PieceValueAgent': agents.SampleMinimaxAgent,
     'ValueNetworkAgent': value_network_agent.ValueNetworkAgent,
     'RandomAgent': mcts.RandomMoveAgent,
-    'RandomPlayoutAgent': mcts.RandomPlayoutAgent
+    'RandomPlayoutAgent': mcts.RandomPlayoutAgent,
+    'MCTSAgent': mcts.MCTSAgent,
+    'ValueNetworkMCTSAgent': value_network_agent.ValueNetworkMCTSAgent
 }
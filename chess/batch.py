@@ -0,0 +1,189 @@
+"""
+Many positions at once, stored as NumPy arrays so attack sets, occupancy and
+checks are computed with one vectorized shift per direction for the whole
+batch instead of one interpreted loop per position. Used for data generation
+and for extracting network features from many positions.
+"""
+from typing import List
+
+import numpy as np
+
+from chess.state import State, MASK_UP, MASK_DOWN, MASK_LEFT, MASK_RIGHT, \
+    MASK_UP2, MASK_DOWN2, MASK_LEFT2, MASK_RIGHT2, MASK_UL, MASK_UR, \
+    MASK_DL, MASK_DR, ROOK_DIRECTIONS, BISHOP_DIRECTIONS
+
+ALL_SQUARES = np.uint64(0xffffffffffffffff)
+
+# (edge mask, shift) for each knight and king step, the same steps used to
+# build KNIGHT_MOVES and KING_MOVES in chess/state.py
+KNIGHT_STEPS = (
+    (MASK_LEFT | MASK_LEFT2 | MASK_UP, 10),
+    (MASK_RIGHT | MASK_RIGHT2 | MASK_UP, 6),
+    (MASK_RIGHT | MASK_RIGHT2 | MASK_DOWN, -10),
+    (MASK_LEFT | MASK_LEFT2 | MASK_DOWN, -6),
+    (MASK_UP | MASK_UP2 | MASK_LEFT, 17),
+    (MASK_UP | MASK_UP2 | MASK_RIGHT, 15),
+    (MASK_DOWN | MASK_DOWN2 | MASK_RIGHT, -17),
+    (MASK_DOWN | MASK_DOWN2 | MASK_LEFT, -15),
+)
+KING_STEPS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+
+# Feature value of each of the 12 boards, matching State.to_ndarray
+PIECE_FEATURES = np.array([0, 1, 2, 3, 4, 5, 0, -1, -2, -3, -4, -5],
+                          dtype=np.float64)
+
+
+def _step(boards: np.ndarray, edge: int, shift: int) -> np.ndarray:
+    """
+    Move every piece one step, dropping those that would leave the board
+    """
+    boards = boards & ~np.uint64(edge)
+    if shift > 0:
+        return boards << np.uint64(shift)
+    return boards >> np.uint64(-shift)
+
+
+def _slide(sliders: np.ndarray, empty: np.ndarray, edge: int,
+           shift: int) -> np.ndarray:
+    """
+    Squares attacked along one direction, stopping at the first piece in the
+    way. Seven steps reach across the board from any square
+    """
+    out = np.zeros_like(sliders)
+    ray = sliders
+    for _ in range(7):
+        ray = _step(ray, edge, shift)
+        out |= ray
+        ray &= empty
+    return out
+
+
+class BatchState:
+    """
+    N positions, each as 12 bitboards: white pawns, knights, bishops, rooks,
+    queens and king, then the same for black
+    """
+    def __init__(self, pieces: np.ndarray, white_turn: np.ndarray) -> None:
+        """
+        Params:
+        ------
+        pieces: np.ndarray
+            (N, 12) uint64 bitboards
+        white_turn: np.ndarray
+            (N,) bool, whether white is to move in each position
+        """
+        pieces = np.asarray(pieces, dtype=np.uint64)
+        white_turn = np.asarray(white_turn, dtype=bool)
+        if pieces.ndim != 2 or pieces.shape[1] != 12 or \
+                white_turn.shape != pieces.shape[:1]:
+            raise ValueError('Expected (N, 12) pieces and (N,) turns, got %s '
+                             'and %s' % (pieces.shape, white_turn.shape))
+        self.pieces = pieces
+        self.white_turn = white_turn
+
+    @staticmethod
+    def from_states(states: List['State']) -> 'BatchState':
+        pieces = np.array([s.white + s.black for s in states],
+                          dtype=np.uint64).reshape(len(states), 12)
+        white_turn = np.array([s.white_turn for s in states], dtype=bool)
+        return BatchState(pieces, white_turn)
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    @property
+    def white_pos(self) -> np.ndarray:
+        return np.bitwise_or.reduce(self.pieces[:, :6], axis=1)
+
+    @property
+    def black_pos(self) -> np.ndarray:
+        return np.bitwise_or.reduce(self.pieces[:, 6:], axis=1)
+
+    @property
+    def occupancy(self) -> np.ndarray:
+        return np.bitwise_or.reduce(self.pieces, axis=1)
+
+    def attacks(self, white: bool) -> np.ndarray:
+        """
+        Squares attacked by each piece type of one side, whether or not the
+        attacking move would be legal
+        Params:
+        ------
+        white: bool
+            Side whose attacks to compute
+        Returns:
+        ------
+        np.ndarray:
+            (N, 6) uint64 attack sets, indexed like the pieces
+        """
+        player = self.pieces[:, :6] if white else self.pieces[:, 6:]
+        empty = ~self.occupancy
+        out = np.zeros_like(player)
+
+        pawns = player[:, 0]
+        if white:
+            out[:, 0] = _step(pawns, MASK_UL, 9) | _step(pawns, MASK_UR, 7)
+        else:
+            out[:, 0] = _step(pawns, MASK_DR, -9) | _step(pawns, MASK_DL, -7)
+        for edge, shift in KNIGHT_STEPS:
+            out[:, 1] |= _step(player[:, 1], edge, shift)
+        for edge, shift in BISHOP_DIRECTIONS:
+            out[:, 2] |= _slide(player[:, 2], empty, edge, shift)
+            out[:, 4] |= _slide(player[:, 4], empty, edge, shift)
+        for edge, shift in ROOK_DIRECTIONS:
+            out[:, 3] |= _slide(player[:, 3], empty, edge, shift)
+            out[:, 4] |= _slide(player[:, 4], empty, edge, shift)
+        for edge, shift in KING_STEPS:
+            out[:, 5] |= _step(player[:, 5], edge, shift)
+        return out
+
+    def attack_map(self, white: bool) -> np.ndarray:
+        """
+        (N,) bitboards of every square attacked by one side
+        """
+        return np.bitwise_or.reduce(self.attacks(white), axis=1)
+
+    def in_check(self) -> np.ndarray:
+        """
+        (N,) bool, whether the side to move is in check
+        """
+        white_king = self.pieces[:, 5]
+        black_king = self.pieces[:, 11]
+        # Each side's attacks are computed for the whole batch at once, then
+        # the right one picked for every position
+        white_checked = (self.attack_map(False) & white_king) != 0
+        black_checked = (self.attack_map(True) & black_king) != 0
+        return np.where(self.white_turn, white_checked, black_checked)
+
+    def to_ndarray(self) -> np.ndarray:
+        """
+        (N, 8, 8) boards, the same as stacking State.to_ndarray for every
+        position
+        """
+        n = len(self)
+        # Little endian bytes with little endian bits put bit i at index i
+        bits = np.unpackbits(
+            self.pieces.astype('<u8').view(np.uint8).reshape(n, 12, 8),
+            axis=-1, bitorder='little')
+        # Boards are indexed from the top left corner, which is bit 63
+        boards = bits[:, :, ::-1].astype(np.float64)
+        return np.tensordot(PIECE_FEATURES, boards,
+                            axes=(0, 1)).reshape(n, 8, 8)
+
+    def features(self, white: np.ndarray = None) -> np.ndarray:
+        """
+        (N, 64) network inputs, seen from one side: positions where that side
+        is black are mirrored and negated, the way ValueNetworkAgent flips them
+        Params:
+        ------
+        white: np.ndarray
+            (N,) bool side to see each position from, by default the side to
+            move
+        """
+        if white is None:
+            white = self.white_turn
+        boards = self.to_ndarray()
+        flipped = -boards[:, ::-1]
+        boards = np.where(np.asarray(white, dtype=bool)[:, None, None],
+                          boards, flipped)
+        return boards.reshape(len(self), 64)
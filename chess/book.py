@@ -0,0 +1,319 @@
+"""
+Opening book: moves played from known positions, looked up by the position's
+Zobrist key instead of searched. The book is a binary file of fixed size
+entries sorted by key, written once by build_book from game records and
+memory-mapped by OpeningBook, so a lookup is a binary search over pages the
+operating system loads on demand, and opening the book costs nothing
+however big it is.
+
+Game records are lines of moves, either in coordinate notation (e2e4,
+e7e8q) or standard algebraic notation (e4, Nxf3, O-O, e8=Q+). Move numbers,
+results and comments, as in PGN movetext, are skipped.
+
+Run as python -m chess.book GAMES BOOK to build a book from a file of games.
+"""
+import argparse
+import bisect
+import mmap
+import random
+import re
+import struct
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from chess.agents import Agent
+from chess.state import State, IllegalMoveException
+
+MAGIC = b'CHESSBK1'
+# Zobrist key, from square, to square, promotion piece index, padding, weight
+ENTRY = struct.Struct('<QBBBxI')
+KEY = struct.Struct('<Q')
+
+# Promotion piece indexes by letter
+PROMOTIONS = {'n': 1, 'b': 2, 'r': 3, 'q': 4}
+PIECES = {'': 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4, 'K': 5}
+FILE_NAMES = 'abcdefgh'
+
+COORDINATE = re.compile(r'^([a-h][1-8])([a-h][1-8])([nbrq])?$')
+SAN = re.compile(r'^([NBRQK]?)([a-h]?)([1-8]?)x?([a-h][1-8])(?:=?([NBRQ]))?'
+                 r'[+#]?[!?]*$')
+CASTLES = re.compile(r'^([O0]-[O0](-[O0])?)[+#]?[!?]*$')
+# Move numbers and results in PGN movetext
+SKIPPED = re.compile(r'^(\d+\.+|1-0|0-1|1/2-1/2|\*)$')
+# PGN comments, in braces or from a semicolon to the end of the line
+COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+BookMove = Tuple[Tuple[int, int], int, int]
+
+
+def square(name: str) -> int:
+    """
+    Bitboard of a square given by name, like e4
+    """
+    return 1 << (8 * (int(name[1]) - 1) + 7 - FILE_NAMES.index(name[0]))
+
+
+def parse_move(state: 'State', text: str) -> Tuple[Tuple[int, int], int]:
+    """
+    Find the legal move text describes in state
+    Params:
+    ------
+    state: State
+        Position the move is played from
+    text: str
+        Move in coordinate or standard algebraic notation
+    Returns:
+    ------
+    Tuple[Tuple[int, int], int]:
+        The move and the index of the piece a pawn promotes to
+    """
+    legal = state.list_legal_moves()
+    match = COORDINATE.match(text)
+    if match:
+        move = (square(match.group(1)), square(match.group(2)))
+        promotion_ix = PROMOTIONS[match.group(3) or 'q']
+        if move in legal:
+            return move, promotion_ix
+        raise IllegalMoveException('Illegal move %s' % text)
+
+    match = CASTLES.match(text)
+    if match:
+        king = 0x8 if state.white_turn else 0x8 << 56
+        target = king << 2 if match.group(2) else king >> 2
+        if (king, target) in legal and state.find_ix(king) == 5:
+            return (king, target), 4
+        raise IllegalMoveException('Illegal move %s' % text)
+
+    match = SAN.match(text)
+    if not match:
+        raise IllegalMoveException('Unknown move notation %s' % text)
+    piece, from_file, from_rank, target, promotion = match.groups()
+    me = state.white if state.white_turn else state.black
+    pieces = me[PIECES[piece]]
+    target = square(target)
+    found = []
+    for move in legal:
+        source = move[0]
+        if move[1] != target or not source & pieces:
+            continue
+        name = '%s%d' % (FILE_NAMES[7 - (source.bit_length() - 1) % 8],
+                         (source.bit_length() - 1) // 8 + 1)
+        if from_file and name[0] != from_file or \
+                from_rank and name[1] != from_rank:
+            continue
+        found.append(move)
+    if len(found) != 1:
+        raise IllegalMoveException('%s move %s'
+                                   % ('Ambiguous' if found else 'Illegal',
+                                      text))
+    return found[0], PROMOTIONS[(promotion or 'q').lower()]
+
+
+def game_moves(game: str) -> List[str]:
+    """
+    The moves in a game record, without move numbers, comments or the result
+    """
+    moves = []
+    for token in COMMENT.sub(' ', game).split():
+        if SKIPPED.match(token):
+            continue
+        token = MOVE_NUMBER.sub('', token)
+        if token:
+            moves.append(token)
+    return moves
+
+
+def build_book(games: Iterable[str], path: str, max_plies: int = 20,
+               min_count: int = 1) -> int:
+    """
+    Write a book of the moves played in the first max_plies plies of games,
+    each weighted by how many games played it from the same position
+    Params:
+    ------
+    games: Iterable[str]
+        Game records from the starting position, one string per game
+    path: str
+        File to write the book to
+    max_plies: int
+        Moves of each game to add to the book
+    min_count: int
+        Games that must play a move for it to go in the book
+    Returns:
+    ------
+    int:
+        Number of entries written
+    """
+    counts = Counter()
+    for n, game in enumerate(games):
+        state = State()
+        for ply, text in enumerate(game_moves(game)[:max_plies]):
+            try:
+                move, promotion_ix = parse_move(state, text)
+            except IllegalMoveException as e:
+                raise IllegalMoveException('%s in game %d, ply %d'
+                                           % (e.message, n + 1, ply + 1))
+            counts[state.zobrist, move, promotion_ix] += 1
+            state.make_move(move, promotion_ix)
+
+    # Sorted by key, and the most played move first within each position
+    entries = sorted(((key, move, promotion_ix, count)
+                      for (key, move, promotion_ix), count in counts.items()
+                      if count >= min_count),
+                     key=lambda entry: (entry[0], -entry[3]))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for key, (piece, target), promotion_ix, count in entries:
+            f.write(ENTRY.pack(key, piece.bit_length() - 1,
+                               target.bit_length() - 1, promotion_ix,
+                               min(count, 0xffffffff)))
+    return len(entries)
+
+
+class _Keys:
+    """
+    Sequence of the keys in a book, for bisect
+    """
+    def __init__(self, data: mmap.mmap, length: int) -> None:
+        self.data = data
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i: int) -> int:
+        return KEY.unpack_from(self.data, len(MAGIC) + i * ENTRY.size)[0]
+
+
+class OpeningBook:
+    def __init__(self, path: str) -> None:
+        """
+        Params:
+        ------
+        path: str
+            Book written by build_book
+        """
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._data) - len(MAGIC)
+        if self._data[:len(MAGIC)] != MAGIC or size % ENTRY.size:
+            self._data.close()
+            raise ValueError('%s is not an opening book' % path)
+        self._keys = _Keys(self._data, size // ENTRY.size)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __enter__(self) -> 'OpeningBook':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._data.close()
+
+    def moves(self, state: 'State') -> List[BookMove]:
+        """
+        Moves the book has for state, most played first
+        Returns:
+        ------
+        List[Tuple[Tuple[int, int], int, int]]:
+            Each move, the index of the piece a pawn promotes to and its
+            weight
+        """
+        keys = self._keys
+        i = bisect.bisect_left(keys, state.zobrist)
+        moves = []
+        while i < len(keys):
+            key, piece, target, promotion_ix, weight = ENTRY.unpack_from(
+                self._data, len(MAGIC) + i * ENTRY.size)
+            if key != state.zobrist:
+                break
+            moves.append(((1 << piece, 1 << target), promotion_ix, weight))
+            i += 1
+        return moves
+
+    def choose(self, state: 'State', rng=random) \
+            -> Optional[Tuple[int, int]]:
+        """
+        Pick one of the book's moves for state at random, in proportion to
+        its weight, or None if the book has no legal move for it
+        Params:
+        ------
+        state: State
+            Position to move from
+        rng:
+            Source of randomness with a random method, like random.Random
+        """
+        moves = self.moves(state)
+        if not moves:
+            return None
+        # Another position with the same key is very unlikely, but it
+        # mustn't produce an illegal move
+        legal = state.list_legal_moves()
+        moves = [(move, weight) for move, _, weight in moves if move in legal]
+        r = rng.random() * sum(weight for _, weight in moves)
+        for move, weight in moves:
+            r -= weight
+            if r < 0:
+                return move
+        return None
+
+
+class BookAgent(Agent):
+    def __init__(self, agent: Agent, book: OpeningBook,
+                 rng=random) -> None:
+        """
+        Play from the opening book while it knows the position, and let
+        agent search once it doesn't
+        Params:
+        ------
+        agent: Agent
+            Agent choosing the moves the book doesn't have
+        book: OpeningBook
+            Book to look moves up in
+        rng:
+            Source of randomness choosing between the book's moves
+        """
+        self.agent = agent
+        self.book = book
+        self.rng = rng
+
+    @property
+    def stats(self):
+        """
+        The wrapped agent's stats, which book moves are reported to as well
+        """
+        return self.agent.stats
+
+    @stats.setter
+    def stats(self, stats) -> None:
+        self.agent.stats = stats
+
+    def select_move(self, state: 'State') -> Tuple[int, int]:
+        move = self.book.choose(state, self.rng)
+        if move is None:
+            return self.agent.select_move(state)
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+            stats.finish(self, move, 0, book=True)
+        return move
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build an opening book from game records, one game per '
+                    'line')
+    parser.add_argument('games', help='File of game records')
+    parser.add_argument('book', help='File to write the book to')
+    parser.add_argument('--plies', type=int, default=20,
+                        help='Moves of each game to add to the book')
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='Games that must play a move for it to go in '
+                             'the book')
+    args = parser.parse_args()
+    with open(args.games) as f:
+        n = build_book(f, args.book, args.plies, args.min_count)
+    print('Wrote %d moves to %s' % (n, args.book))
@@ -0,0 +1,179 @@
+"""
+Counters an agent fills in while it searches, for tuning the search and
+spotting regressions. Attach a SearchStats to any agent with
+agent.stats = SearchStats(...); agents only touch it when it is set, so
+leaving it as None costs one check per node. After every select_move the
+counters are summed up in a report, a dict of JSON types, which is passed to
+each hook.
+"""
+import json
+import time
+from typing import Callable, Iterator, List, Optional, Tuple
+
+Report = dict
+Hook = Callable[[Report], None]
+
+
+def json_lines(path: str) -> Hook:
+    """
+    Hook appending each report to a file as one line of JSON
+    """
+    def write(report: Report) -> None:
+        with open(path, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+    return write
+
+
+class SearchStats:
+    def __init__(self, *hooks: Hook) -> None:
+        """
+        Params:
+        ------
+        hooks: Callable[[dict], None]
+            Called with the report at the end of every select_move
+        """
+        self.hooks = list(hooks)
+        self.report = None
+        self.start()
+
+    def start(self, table=None) -> None:
+        """
+        Reset the counters for a new search
+        Params:
+        ------
+        table: TranspositionTable
+            Table the search probes, if any, to count its hits
+        """
+        self.nodes_per_ply = []
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        # Total nodes searched when each iteration of a deepening search
+        # finished
+        self.iterations = []
+        self.movegen_time = 0.0
+        self.eval_time = 0.0
+        self._table = table
+        self._table_counts = (0, 0) if table is None else \
+            (table.probes, table.hits)
+        self._start = time.perf_counter()
+
+    def node(self, ply: int, count: int = 1) -> None:
+        """
+        Count positions searched ply moves from the root
+        """
+        counts = self.nodes_per_ply
+        try:
+            counts[ply] += count
+        except IndexError:
+            counts.extend([0] * (ply + 1 - len(counts)))
+            counts[ply] += count
+
+    def cutoff(self, first: bool) -> None:
+        """
+        Count a beta cutoff, and whether the first move searched caused it
+        """
+        self.cutoffs += 1
+        if first:
+            self.first_move_cutoffs += 1
+
+    def moves(self, moves: Iterator[Tuple[int, int]]) \
+            -> Iterator[Tuple[int, int]]:
+        """
+        Pass moves through from a generator, counting the time spent
+        generating them
+        """
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            move = next(moves, None)
+            self.movegen_time += clock() - start
+            if move is None:
+                return
+            yield move
+
+    def evaluate(self, heuristic: Callable, state) -> float:
+        """
+        Call heuristic on state, counting the time it takes
+        """
+        start = time.perf_counter()
+        score = heuristic(state)
+        self.eval_time += time.perf_counter() - start
+        return score
+
+    def iteration(self, depth: int, nodes: int) -> None:
+        """
+        Record an iteration of a deepening search finishing
+        """
+        self.iterations.append((depth, nodes))
+
+    def finish(self, agent, move: Optional[Tuple[int, int]],
+               nodes: int = None, **fields) -> Report:
+        """
+        Sum the counters up in a report and pass it to the hooks
+        Params:
+        ------
+        agent: Agent
+            Agent that searched
+        move: Tuple[int, int]
+            Move chosen, or None
+        nodes: int
+            Positions searched, if the agent counts more than were passed to
+            node, otherwise their sum
+        fields:
+            Anything else to report, as JSON types
+        Returns:
+        ------
+        dict:
+            The report
+        """
+        elapsed = time.perf_counter() - self._start
+        if nodes is None:
+            nodes = sum(self.nodes_per_ply)
+        report = {
+            'agent': type(agent).__name__,
+            'move': None if move is None else
+            [move[0].bit_length() - 1, move[1].bit_length() - 1],
+            'time': elapsed,
+            'nodes': nodes,
+            'nps': nodes / elapsed if elapsed > 0 else None,
+            'nodes_per_ply': list(self.nodes_per_ply),
+            'max_ply': len(self.nodes_per_ply) - 1,
+            'depth': self.iterations[-1][0] if self.iterations else None,
+            'branching_factor': self.branching_factor(),
+            'cutoffs': self.cutoffs,
+            'first_move_cutoff_rate': self.first_move_cutoffs / self.cutoffs
+            if self.cutoffs else None,
+            'time_movegen': self.movegen_time,
+            'time_eval': self.eval_time,
+            'time_search': elapsed - self.movegen_time - self.eval_time,
+        }
+        if self._table is not None:
+            probes = self._table.probes - self._table_counts[0]
+            hits = self._table.hits - self._table_counts[1]
+            report['tt_probes'] = probes
+            report['tt_hit_rate'] = hits / probes if probes else None
+        report.update(fields)
+        self.report = report
+        for hook in self.hooks:
+            hook(report)
+        return report
+
+    def branching_factor(self) -> Optional[float]:
+        """
+        Effective branching factor: how many times more nodes the last
+        iteration searched than the one before, or None with fewer than two
+        """
+        per_iteration = self._iteration_nodes()
+        if len(per_iteration) < 2 or per_iteration[-2] == 0:
+            return None
+        return per_iteration[-1] / per_iteration[-2]
+
+    def _iteration_nodes(self) -> List[int]:
+        totals = [nodes for _, nodes in self.iterations]
+        return [b - a for a, b in zip([0] + totals, totals)]
+
+    def to_json(self) -> str:
+        """
+        The last report as JSON
+        """
+        return json.dumps(self.report)
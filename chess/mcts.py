@@ -1,13 +1,31 @@
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
+import math
+import multiprocessing
 import random
 from collections import Counter
 
 import time
 
-from chess.state import GameResult, State
-from chess.agents import Agent
+from chess.state import GameResult, State, PIECE_VALUES
+from chess.agents import Agent, PoolAgent, flag, optional, worker_agent
+from chess.instrumentation import SearchStats
+from chess.playout import random_playout
+
+# Tree policies for MCTSAgent
+UCT = 'uct'
+PUCT = 'puct'
+POLICIES = (UCT, PUCT)
+
+# What a finished playout is worth to white. Playouts cut off before the end
+# of the game count as draws
+WHITE_REWARDS = {
+    GameResult.P1_WINS: 1.0,
+    GameResult.P2_WINS: 0.0,
+    GameResult.DRAW: 0.5,
+    GameResult.NONTERMINAL: 0.5,
+}
 
 
 class RandomMoveAgent(Agent):
@@ -18,36 +36,94 @@ class RandomMoveAgent(Agent):
         return self.random_child(state).prev_move
 
 
-class RandomPlayoutAgent(Agent):
-    def __init__(self, max_time=3, max_depth=100):
-        self.max_time = max_time
-        self.max_depth = max_depth
+class RandomPlayoutAgent(PoolAgent):
+    def __init__(self, max_time=3, max_depth=100, workers=1, seed=None):
+        """
+        Params:
+        ------
+        max_time: float
+            Seconds to spend on playouts
+        max_depth: int
+            Moves a playout makes before it is stopped and scored as a draw
+        workers: int
+            Processes to run playouts in, see PoolAgent
+        seed: int
+            Seed of the workers' random number generators, each of which
+            gets its own stream. None to seed them from the system
+        """
+        self.max_time = float(max_time)
+        self.max_depth = int(max_depth)
+        self.workers = int(workers)
+        self.seed = None if seed is None else int(seed)
+        # Playouts run by the last select_move
+        self.playouts = 0
+        self._rng = random
+        self._pool = None
+
+    def __getstate__(self):
+        # Workers make their own generator
+        state = super().__getstate__()
+        state['_rng'] = None
+        return state
+
+    def init_worker(self, index) -> None:
+        """
+        Give the worker a generator of its own, seeded from the next value
+        of the shared index
+        """
+        with index.get_lock():
+            worker = index.value
+            index.value += 1
+        seed = None if self.seed is None else '%d:%d' % (self.seed, worker)
+        self._rng = random.Random(seed)
 
     def select_move(self, state: 'State'):
+        stats = self.stats
+        if stats is not None:
+            stats.start()
         best_child = self.playout_many(state)
+        if stats is not None:
+            stats.finish(self, best_child.prev_move, playouts=self.playouts)
         return best_child.prev_move
 
     def playout(self, state: 'State', start_depth: int = 0):
-        depth = start_depth
-        result = state.is_terminal()
-        while depth < self.max_depth and result == GameResult.NONTERMINAL:
-            sss = state
-            state = state.get_random_child()
-            if state is None:
-                print(sss)
-                print(sss.white_turn)
-            result = state.is_terminal()
-            depth += 1
+        result, plies = random_playout(state, self.max_depth - start_depth,
+                                       self._rng)
+        stats = self.stats
+        if stats is not None:
+            for depth in range(start_depth + 1, start_depth + plies + 1):
+                stats.node(depth)
         return result
 
     def playout_many(self, state: 'State') -> 'State':
+        children = list(state.get_children())
+        deadline = time.time() + self.max_time
+        if self.workers > 1:
+            rewards, self.playouts = self._parallel_playouts(state, deadline)
+        else:
+            rewards, self.playouts = self.playouts_until(state, children,
+                                                         deadline)
+        best_move, total_reward = rewards.most_common(1)[0]
+        for child in children:
+            if child.prev_move == best_move:
+                return child
+
+    def playouts_until(self, state: 'State', children: List['State'],
+                       deadline: float) -> Tuple[Counter, int]:
+        """
+        Play games out from random children of state until the deadline,
+        always at least one
+        Returns:
+        ------
+        Tuple[Counter, int]:
+            Total reward of each move, for the side to move in state, and
+            the number of playouts
+        """
         white_turn = state.white_turn
         counter = Counter()
-        start = time.time()
-        end = start
-        children = list(state.get_children())
-        while end - start < self.max_time:
-            child = random.choice(children)
+        n_playouts = 0
+        while True:
+            child = self._rng.choice(children)
             result = self.playout(child, 1)
             if result in (GameResult.NONTERMINAL, GameResult.DRAW):
                 reward = 0
@@ -56,8 +132,345 @@ class RandomPlayoutAgent(Agent):
                 reward = 1
             else:
                 reward = -1
-            counter[child] += reward
-            end = time.time()
-        best_child, total_reward = counter.most_common(1)[0]
+            counter[child.prev_move] += reward
+            n_playouts += 1
+            if time.time() >= deadline:
+                return counter, n_playouts
+
+    def _parallel_playouts(self, state: 'State',
+                           deadline: float) -> Tuple[Counter, int]:
+        """
+        Run playouts in every worker process until the deadline and add
+        their rewards up, and their nodes to stats
+        """
+        if self._pool is None:
+            self._start_pool(multiprocessing.Value('i', 0))
+        stats = self.stats
+        futures = [self._pool.submit(_playouts_until, state, deadline,
+                                     stats is not None)
+                   for _ in range(self.workers)]
+        rewards = Counter()
+        n_playouts = 0
+        for future in futures:
+            counter, n, nodes_per_ply = future.result()
+            # update, unlike +=, keeps moves with no or negative reward
+            rewards.update(counter)
+            n_playouts += n
+            for ply, count in enumerate(nodes_per_ply):
+                stats.node(ply, count)
+        return rewards, n_playouts
+
+
+def _playouts_until(state: 'State', deadline: float,
+                    count_nodes: bool) -> Tuple[Counter, int, List[int]]:
+    """
+    Run playouts in a worker process
+    Returns:
+    ------
+    Tuple[Counter, int, List[int]]:
+        What playouts_until returns, and the nodes played out at each ply
+        if count_nodes is set, otherwise nothing
+    """
+    agent = worker_agent()
+    agent.stats = SearchStats() if count_nodes else None
+    counter, n_playouts = agent.playouts_until(
+        state, list(state.get_children()), deadline)
+    nodes_per_ply = [] if agent.stats is None else agent.stats.nodes_per_ply
+    return counter, n_playouts, nodes_per_ply
+
+
+class Node:
+    """
+    A position in the search tree, reached from its parent by move
+    """
+    # Trees grow to hundreds of thousands of nodes
+    __slots__ = ('move', 'parent', 'white', 'prior', 'children', 'result',
+                 'visits', 'value')
+
+    def __init__(self, move: Tuple[int, int] = None, parent: 'Node' = None,
+                 white: bool = True, prior: float = 1.0) -> None:
+        self.move = move
+        self.parent = parent
+        # Whether white made the move, so whose rewards value adds up
+        self.white = white
+        self.prior = prior
+        # None until expanded, empty if the game is over here
+        self.children = None
+        self.result = None
+        self.visits = 0
+        self.value = 0.0
+
+    def child(self, move: Tuple[int, int]) -> 'Node':
+        """
+        The child reached by move, or None if it isn't in the tree
+        """
+        for child in self.children or ():
+            if child.move == move:
+                return child
+        return None
+
+
+class MCTSAgent(Agent):
+    def __init__(self, max_time: float = 3, max_playouts: int = None,
+                 exploration: float = 1.4, policy: str = UCT,
+                 max_depth: int = 100, reuse_tree: bool = True,
+                 batch_size: int = 1, virtual_loss: int = 1) -> None:
+        """
+        Monte Carlo tree search: grow a tree from the position one node per
+        playout, walking down it to the child with the best upper confidence
+        bound, and play the move visited most
+        Params:
+        ------
+        max_time: float
+            Seconds select_move may take, or None for no limit
+        max_playouts: int
+            Playouts select_move may run, or None for no limit
+        exploration: float
+            Weight of the exploration term against the average reward, which
+            is between 0 and 1
+        policy: str
+            UCT, using visit counts alone, or PUCT, which also weighs each
+            move by its prior from priors
+        max_depth: int
+            Moves a playout makes before it is stopped and scored as a draw
+        reuse_tree: bool
+            Keep the subtree of the position after the opponent's reply for
+            the next select_move, if it was explored
+        batch_size: int
+            Leaves to walk down to before scoring them all in one call to
+            evaluate, which pays off when evaluate scores a batch faster than
+            one position at a time
+        virtual_loss: int
+            Lost visits added to every node on the way to a leaf until the
+            leaf is scored, so the other walks of a batch spread out instead
+            of all reaching the same leaf
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown tree policy %r, expected one of %s'
+                             % (policy, ', '.join(POLICIES)))
+        self.max_time = optional(max_time)
+        self.max_playouts = optional(max_playouts, int)
+        if self.max_time is None and self.max_playouts is None:
+            raise ValueError('Please give a time or playout budget')
+        self.exploration = float(exploration)
+        self.policy = policy
+        self.max_depth = int(max_depth)
+        self.reuse_tree = flag(reuse_tree)
+        self.batch_size = int(batch_size)
+        self.virtual_loss = int(virtual_loss)
+        if self.batch_size < 1:
+            raise ValueError('batch_size must be at least 1, got %d'
+                             % self.batch_size)
+        self.root = None
+        self.root_state = None
+        # Playouts made by the last select_move, and how many visits the
+        # root already had from earlier searches
+        self.playouts = 0
+        self.reused_visits = 0
+
+    def select_move(self, state: 'State') -> Tuple[int, int]:
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+        root = self._find_root(state)
+        self.reused_visits = root.visits
+        self.playouts = 0
+        deadline = None if self.max_time is None else \
+            time.time() + self.max_time
+        # Always finish one batch, so there is a move to return
+        while True:
+            batch_size = self.batch_size
+            if self.max_playouts is not None:
+                batch_size = min(batch_size,
+                                 self.max_playouts - self.playouts)
+            self._iterate(root, state, batch_size)
+            self.playouts += batch_size
+            if self.max_playouts is not None and \
+                    self.playouts >= self.max_playouts:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            if root.children == []:
+                break
+        if not root.children:
+            if stats is not None:
+                stats.finish(self, None, playouts=self.playouts,
+                             reused_visits=self.reused_visits)
+            return None
+        best = max(root.children, key=lambda child: child.visits)
+        # The position after this move is the parent of the next search's
+        # root, if the opponent's reply was explored. The rest of the tree
+        # can go
+        best.parent = None
+        self.root = best
+        self.root_state = state.get_child(*best.move)
+        if stats is not None:
+            stats.finish(self, best.move, playouts=self.playouts,
+                         reused_visits=self.reused_visits)
+        return best.move
+
+    def _find_root(self, state: 'State') -> Node:
+        """
+        The node for state from the last search's tree, or a new one
+        """
+        if self.reuse_tree and self.root is not None and \
+                state.prev_move is not None:
+            child = self.root.child(state.prev_move)
+            if child is not None and \
+                    self.root_state.get_child(*state.prev_move) == state:
+                child.parent = None
+                return child
+        self.root = self.root_state = None
+        return Node(white=not state.white_turn)
+
+    def _iterate(self, root: Node, root_state: 'State',
+                 batch_size: int = 1) -> None:
+        """
+        One round of selection, expansion, playout and backing up, for
+        batch_size leaves at once
+        """
+        leaves = []
+        states = []
+        for _ in range(batch_size):
+            node, state = self._descend(root, root_state)
+            leaves.append(node)
+            if node.result is None:
+                states.append(state)
+        rewards = iter(self._evaluate(states) if states else ())
+        virtual_loss = self.virtual_loss
+        for node in leaves:
+            if node.result is not None:
+                reward = WHITE_REWARDS[node.result]
+            else:
+                reward = next(rewards)
+            # Take the virtual losses back, leaving one real visit
+            while node is not None:
+                node.visits += 1 - virtual_loss
+                node.value += reward if node.white else 1 - reward
+                node = node.parent
+
+    def _descend(self, root: Node, root_state: 'State') \
+            -> Tuple[Node, 'State']:
+        """
+        Walk down from the root to a leaf, expanding it if it was never
+        visited, and count a virtual loss on every node passed
+        Returns:
+        ------
+        Tuple[Node, State]:
+            The leaf and its position
+        """
+        stats = self.stats
+        virtual_loss = self.virtual_loss
+        node = root
+        node.visits += virtual_loss
+        state = root_state.copy()
+        ply = 0
+        while node.children:
+            node = self._select(node)
+            node.visits += virtual_loss
+            state.make_move(node.move)
+            ply += 1
+            if stats is not None:
+                stats.node(ply)
+        if node.children is None:
+            self._expand(node, state)
+            if node.children:
+                node = self._select(node)
+                node.visits += virtual_loss
+                state.make_move(node.move)
+                if stats is not None:
+                    stats.node(ply + 1)
+        return node, state
+
+    def _evaluate(self, states: List['State']) -> List[float]:
+        stats = self.stats
+        if stats is None:
+            return self.evaluate(states)
+        start = time.perf_counter()
+        rewards = self.evaluate(states)
+        stats.eval_time += time.perf_counter() - start
+        return rewards
+
+    def evaluate(self, states: List['State']) -> List[float]:
+        """
+        What each leaf is worth to white, between 0 and 1. By default the
+        result of a random playout from it
+        """
+        return [WHITE_REWARDS[self.rollout(state)] for state in states]
+
+    def _expand(self, node: Node, state: 'State') -> None:
+        """
+        Add a child for every legal move, or mark the node as the end of the
+        game
+        """
+        moves = state.list_legal_moves()
+        result = state.is_terminal()
+        if result:
+            node.children = []
+            node.result = result
+            return
+        moves = moves[:]
+        random.shuffle(moves)
+        white = state.white_turn
+        if self.policy == PUCT:
+            priors = self.priors(state, moves)
+        else:
+            priors = [1.0] * len(moves)
+        node.children = [Node(move, node, white, prior)
+                         for move, prior in zip(moves, priors)]
+
+    def _select(self, node: Node) -> Node:
+        """
+        The child with the highest upper confidence bound on its reward
+        """
+        c = self.exploration
+        best = None
+        best_score = -float('inf')
+        if self.policy == UCT:
+            log_visits = math.log(node.visits or 1)
+            for child in node.children:
+                if child.visits == 0:
+                    # Every move is tried once first, in random order
+                    return child
+                score = child.value / child.visits + \
+                    c * math.sqrt(log_visits / child.visits)
+                if score > best_score:
+                    best, best_score = child, score
+        else:
+            root_visits = math.sqrt(node.visits or 1)
+            for child in node.children:
+                # Unvisited moves count as draws until tried
+                q = child.value / child.visits if child.visits else 0.5
+                score = q + c * child.prior * root_visits / (1 + child.visits)
+                if score > best_score:
+                    best, best_score = child, score
+        return best
+
+    def priors(self, state: 'State', moves: List[Tuple[int, int]]) \
+            -> List[float]:
+        """
+        How promising each move looks before it is searched, for PUCT.
+        Captures are weighted by the value of the piece taken
+        """
+        if state.white_turn:
+            them, them_pos = state.black, state.black_pos
+        else:
+            them, them_pos = state.white, state.white_pos
+        weights = []
+        for _, target in moves:
+            weight = 1
+            if target & them_pos:
+                for ix in range(5):
+                    if them[ix] & target:
+                        weight += PIECE_VALUES[ix]
+                        break
+            weights.append(weight)
+        total = sum(weights)
+        return [weight / total for weight in weights]
 
-        return best_child
+    def rollout(self, state: 'State') -> GameResult:
+        """
+        Play random moves from state until the game ends or max_depth moves
+        are made
+        """
+        return random_playout(state, self.max_depth)[0]
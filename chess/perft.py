@@ -0,0 +1,165 @@
+"""
+Perft counts the leaves of the legal move tree to a fixed depth. Comparing the
+counts against known results checks the move generator, and timing them
+measures its raw speed without any agent on top.
+
+Run as `python3 chess/perft.py --depth 3 --position kiwipete --divide`, or
+`python3 chess/perft.py --suite --depth 3` to check every standard position.
+"""
+import argparse
+import sys
+import time
+from typing import List, Tuple
+
+from chess.state import State, bitboard_to_AN, RANKS
+
+# Standard test positions with their published node counts for depth 1, 2...
+# Castling rights are only tracked per player, so the depths listed stop
+# before a rook could leave its corner and come back.
+POSITIONS = {
+    'start': ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+              [20, 400, 8902, 197281]),
+    # Castling, pins, en passant and promotions in the middlegame
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R '
+                 'w KQkq - 0 1',
+                 [48, 2039, 97862, 4085603]),
+    # En passant with the king and a rook on the same rank
+    'endgame': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+                [14, 191, 2812, 43238, 674624]),
+    # Promotions, under promotions and castling for black only
+    'promotions': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 '
+                   'w kq - 0 1',
+                   [6, 264, 9467, 422333]),
+    'position5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+                  [44, 1486, 62379, 2103487]),
+    'position6': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/'
+                  'R4RK1 w - - 0 10',
+                  [46, 2079, 89890, 3894594]),
+}
+
+PROMOTION_NAMES = {1: 'n', 2: 'b', 3: 'r', 4: 'q'}
+
+
+def _promotions(state: 'State', move: Tuple[int, int]) -> Tuple[int, ...]:
+    """
+    Pieces a move can promote to, or just the default if it isn't a promotion
+    """
+    piece, target = move
+    pawns = state.white[0] if state.white_turn else state.black[0]
+    if piece & pawns and target & (RANKS[0] | RANKS[7]):
+        return 4, 3, 2, 1
+    return 4,
+
+
+def perft(state: 'State', depth: int) -> int:
+    """
+    Count the leaf nodes of the legal move tree
+    Params:
+    ------
+    state: State
+        Position to start from, updated in place and restored
+    depth: int
+        Number of plies to search
+    Returns:
+    ------
+    int:
+        Number of positions reached at exactly depth plies
+    """
+    if depth == 0:
+        return 1
+    moves = state.list_legal_moves()
+    if depth == 1:
+        # Bulk count the last ply instead of making every move
+        return sum(len(_promotions(state, move)) for move in moves)
+    nodes = 0
+    for move in moves:
+        for promotion_ix in _promotions(state, move):
+            undo = state.make_move(move, promotion_ix)
+            nodes += perft(state, depth - 1)
+            state.unmake_move(undo)
+    return nodes
+
+
+def divide(state: 'State', depth: int) -> List[Tuple[str, int]]:
+    """
+    Split the perft count by root move, to find which move a wrong count
+    comes from
+    Returns:
+    ------
+    List[Tuple[str, int]]:
+        (move in coordinate notation, node count) for every root move
+    """
+    state = state.copy()
+    out = []
+    for move in state.list_legal_moves():
+        for promotion_ix in _promotions(state, move):
+            name = bitboard_to_AN(move[0]) + bitboard_to_AN(move[1])
+            if len(_promotions(state, move)) > 1:
+                name += PROMOTION_NAMES[promotion_ix]
+            undo = state.make_move(move, promotion_ix)
+            out.append((name, perft(state, depth - 1)))
+            state.unmake_move(undo)
+    return out
+
+
+def run(state: 'State', depth: int, show_divide: bool = False,
+        out=sys.stdout) -> Tuple[int, float]:
+    """
+    Time a perft run and report the node count and nodes per second
+    Returns:
+    ------
+    Tuple[int, float]:
+        Node count and seconds taken
+    """
+    start = time.time()
+    if show_divide:
+        nodes = 0
+        for name, count in sorted(divide(state, depth)):
+            print('%s: %d' % (name, count), file=out)
+            nodes += count
+    else:
+        nodes = perft(state.copy(), depth)
+    elapsed = time.time() - start
+    print('Nodes: %d, time: %.2fs, nodes per second: %.0f' % (
+        nodes, elapsed, nodes / max(elapsed, 1e-9)), file=out)
+    return nodes, elapsed
+
+
+def run_suite(max_depth: int, out=sys.stdout) -> bool:
+    """
+    Check every standard position against its known counts up to max_depth
+    Returns:
+    ------
+    bool:
+        True if every count matched
+    """
+    all_correct = True
+    for name, (fen, counts) in POSITIONS.items():
+        for depth, expected in enumerate(counts[:max_depth], 1):
+            print('%s depth %d' % (name, depth), file=out)
+            nodes, _ = run(State.from_fen(fen), depth, out=out)
+            if nodes != expected:
+                print('Expected %d nodes' % expected, file=out)
+                all_correct = False
+    return all_correct
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count the leaf nodes of the move tree to check and time '
+                    'the move generator')
+    parser.add_argument('--depth', '-d', type=int, default=3,
+                        help='Number of plies to search')
+    parser.add_argument('--position', '-p', choices=sorted(POSITIONS),
+                        default='start', help='Standard position to start from')
+    parser.add_argument('--fen', help='Start from this position instead')
+    parser.add_argument('--divide', action='store_true',
+                        help='Print the node count for every root move')
+    parser.add_argument('--suite', action='store_true',
+                        help='Check every standard position up to --depth')
+    args = parser.parse_args()
+
+    if args.suite:
+        sys.exit(0 if run_suite(args.depth) else 1)
+    fen = args.fen if args.fen is not None else POSITIONS[args.position][0]
+    run(State.from_fen(fen), args.depth, args.divide)
@@ -0,0 +1,195 @@
+"""
+Random games played on bare bitboards, for Monte Carlo agents. A playout
+makes thousands of moves per search, so instead of State objects and legal
+move lists it works on two lists of integers in a loop. Each ply it
+picks uniformly among the pseudo-legal moves, which may leave the king in
+check. The game then ends when a king can be taken, which the side taking it
+wins; checkmate ends the same way a move later. The approximations:
+castling is never played, pawns always promote to queens, and a stalemated
+side that has to move into check loses.
+"""
+import random
+from typing import List, Tuple
+
+from chess.state import State, GameResult, KNIGHT_MOVES, KING_MOVES, \
+    MASK_LEFT, MASK_RIGHT, RANKS, ALL_SQUARES, rook_attacks, bishop_attacks
+
+LAST_RANKS = RANKS[0] | RANKS[7]
+
+
+def pseudo_legal_targets(me: List[int], them: List[int], white_turn: bool,
+                         en_passant: int, sources: List[int],
+                         pieces: List[int], targets: List[int],
+                         counts: List[int]) -> int:
+    """
+    Fill sources, pieces, targets and counts with each piece of the side to
+    move that has a pseudo-legal move: its square, its piece index, the
+    squares it can move to and how many there are. The lists are reused
+    between calls, so only the first entries, up to the returned number, are
+    meaningful
+    Params:
+    ------
+    me: List[int]
+        Bitboards of the side to move, by piece index
+    them: List[int]
+        Bitboards of the other side
+    white_turn: bool
+        Whether white is to move
+    en_passant: int
+        Square a pawn can be taken on en passant, or 0
+    sources, pieces, targets, counts: List[int]
+        Output lists of length 16
+    Returns:
+    ------
+    int:
+        Number of entries filled, or -1 if the other side's king can be
+        taken, in which case the lists are not filled
+    """
+    me_pos = me[0] | me[1] | me[2] | me[3] | me[4] | me[5]
+    them_pos = them[0] | them[1] | them[2] | them[3] | them[4] | them[5]
+    occupancy = me_pos | them_pos
+    empty = ~occupancy & ALL_SQUARES
+    free = ~me_pos & ALL_SQUARES
+    king = them[5]
+    n = 0
+
+    pawns = me[0]
+    captures = them_pos | en_passant
+    while pawns:
+        piece = pawns & -pawns
+        pawns ^= piece
+        if white_turn:
+            moves = (piece << 8) & empty
+            if moves & RANKS[2]:
+                moves |= (moves << 8) & empty
+            moves |= (((piece & ~MASK_LEFT) << 9) |
+                      ((piece & ~MASK_RIGHT) << 7)) & captures
+        else:
+            moves = (piece >> 8) & empty
+            if moves & RANKS[5]:
+                moves |= (moves >> 8) & empty
+            moves |= (((piece & ~MASK_RIGHT) >> 9) |
+                      ((piece & ~MASK_LEFT) >> 7)) & captures
+        if moves:
+            if moves & king:
+                return -1
+            sources[n] = piece
+            pieces[n] = 0
+            targets[n] = moves
+            counts[n] = bin(moves).count('1')
+            n += 1
+
+    for ix in range(1, 6):
+        board = me[ix]
+        while board:
+            piece = board & -board
+            board ^= piece
+            if ix == 1:
+                moves = KNIGHT_MOVES[piece]
+            elif ix == 2:
+                moves = bishop_attacks(piece, occupancy)
+            elif ix == 3:
+                moves = rook_attacks(piece, occupancy)
+            elif ix == 4:
+                moves = rook_attacks(piece, occupancy) | \
+                    bishop_attacks(piece, occupancy)
+            else:
+                moves = KING_MOVES[piece]
+            moves &= free
+            if moves:
+                if moves & king:
+                    return -1
+                sources[n] = piece
+                pieces[n] = ix
+                targets[n] = moves
+                counts[n] = bin(moves).count('1')
+                n += 1
+    return n
+
+
+def random_playout(state: 'State', max_plies: int,
+                   rng=random) -> Tuple[GameResult, int]:
+    """
+    Play random pseudo-legal moves from state until a king can be taken, only
+    kings are left, the side to move has no move at all, or max_plies moves
+    are made. state is not changed
+    Params:
+    ------
+    state: State
+        Position to start from
+    max_plies: int
+        Moves to make before stopping
+    rng:
+        Source of randomness with a randrange method, like random.Random
+    Returns:
+    ------
+    Tuple[GameResult, int]:
+        The result, NONTERMINAL if the playout was stopped, and the number of
+        moves made
+    """
+    # The starting position is checked properly, so a playout from a mated
+    # or stalemated position is scored exactly
+    result = state.is_terminal()
+    if result:
+        return result, 0
+    white = list(state.white)
+    black = list(state.black)
+    white_turn = state.white_turn
+    en_passant = state._en_passant_target()
+    randrange = rng.randrange
+    sources = [0] * 16
+    pieces = [0] * 16
+    targets = [0] * 16
+    counts = [0] * 16
+
+    for ply in range(max_plies):
+        if white_turn:
+            me, them = white, black
+        else:
+            me, them = black, white
+        if me[0] | me[1] | me[2] | me[3] | me[4] == 0 and \
+                them[0] | them[1] | them[2] | them[3] | them[4] == 0:
+            return GameResult.DRAW, ply
+        n = pseudo_legal_targets(me, them, white_turn, en_passant, sources,
+                                 pieces, targets, counts)
+        if n < 0:
+            return (GameResult.P1_WINS if white_turn else
+                    GameResult.P2_WINS), ply
+        if n == 0:
+            return GameResult.DRAW, ply
+
+        # Every move is equally likely: pick one by its position among all
+        # the pieces' targets
+        r = randrange(sum(counts[:n]))
+        for i in range(n):
+            count = counts[i]
+            if r < count:
+                break
+            r -= count
+        moves = targets[i]
+        for _ in range(r):
+            moves &= moves - 1
+        target = moves & -moves
+        piece = sources[i]
+        ix = pieces[i]
+
+        me[ix] ^= piece | target
+        if target & (them[0] | them[1] | them[2] | them[3] | them[4]):
+            for captured in range(5):
+                if them[captured] & target:
+                    them[captured] ^= target
+                    break
+        next_en_passant = 0
+        if ix == 0:
+            if target & LAST_RANKS:
+                me[0] ^= target
+                me[4] |= target
+            elif target == en_passant:
+                them[0] &= ~(target >> 8 if white_turn else target << 8)
+            elif target == piece << 16:
+                next_en_passant = piece << 8
+            elif target == piece >> 16:
+                next_en_passant = piece >> 8
+        en_passant = next_en_passant
+        white_turn = not white_turn
+    return GameResult.NONTERMINAL, max_plies
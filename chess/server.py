@@ -8,13 +8,17 @@ Responses will be of the form  {'pieces':str[64],'winner':[(one of)
 pieces will be lowercase for black, uppercase for white
 """
 import argparse
+import functools
+import threading
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
 from chess.state import State, ChessException, IllegalMoveException
-from chess.agents import SavingAgent, SampleMinimaxAgent
+from chess.agents import SavingAgent, MinimaxAgent, SampleMinimaxAgent
 from chess.all_agents import agent_list
+from chess.book import BookAgent, OpeningBook
+from chess.instrumentation import SearchStats, json_lines
 
 app = Flask(__name__)
 CORS(app)
@@ -28,6 +32,11 @@ c2ix = {
 c2ix.update({k.upper(): v for k, v in c2ix.items()})
 
 agent = SampleMinimaxAgent()
+# Whether the agent keeps searching while the user thinks, see ponder
+ponder = False
+# Held by every request searching with the agent, which the server may
+# handle in several threads at once
+agent_lock = threading.Lock()
 
 
 class MalformedRequestException(ChessException):
@@ -46,6 +55,36 @@ def handle_bad_move(error):
     return response
 
 
+def _using_agent(route):
+    """
+    Run a route holding agent_lock, so requests use the agent, and the
+    search it may run on the user's time, one at a time
+    """
+    @functools.wraps(route)
+    def locked(*args, **kwargs):
+        with agent_lock:
+            return route(*args, **kwargs)
+    return locked
+
+
+def _searcher():
+    """
+    The agent that searches, inside the opening book if there is one
+    """
+    return agent.agent if isinstance(agent, BookAgent) else agent
+
+
+def stop_pondering(state: State = None):
+    """
+    Stop the agent searching in the background, returning its move if it was
+    searching state
+    """
+    searcher = _searcher()
+    if isinstance(searcher, MinimaxAgent):
+        return searcher.stop_pondering(state)
+    return None
+
+
 @app.route('/move', methods=['POST'])
 def make_move():
     data = request.get_json()
@@ -91,6 +130,7 @@ def make_move():
 
 
 @app.route('/moveai', methods=['POST'])
+@_using_agent
 def make_move_ai():
     data = request.get_json()
     try:
@@ -111,11 +151,17 @@ def make_move_ai():
     an = state.to_algebraic_notation(piece, target, c2ix[promo_type])
 
     new_state = state.get_child(piece, target, c2ix[promo_type])
+    # A search started on the user's time is finished if the user played the
+    # move it expected, and thrown away otherwise
+    ai_move = stop_pondering(new_state)
     ai_an = None
     if not new_state.is_terminal():
-        ai_piece, ai_target = agent.select_move(new_state)
-        ai_an = new_state.to_algebraic_notation(ai_piece, ai_target)
-        new_state = new_state.get_child(ai_piece, ai_target)
+        if ai_move is None:
+            ai_move = agent.select_move(new_state)
+        ai_an = new_state.to_algebraic_notation(*ai_move)
+        new_state = new_state.get_child(*ai_move)
+        if ponder and isinstance(_searcher(), MinimaxAgent):
+            _searcher().ponder(new_state)
 
     moves = new_state.list_legal_moves()
     legal_move_dict = {}
@@ -165,6 +211,15 @@ if __name__ == '__main__':
     parser.add_argument('--savefile', '-f', required=False,
                         help='File to load state from (only needed if agent '
                              'uses a from_file method')
+    parser.add_argument('--stats', required=False,
+                        help='File to append search statistics to, as one '
+                             'line of JSON per move')
+    parser.add_argument('--no-ponder', action='store_true',
+                        help="Don't let minimax agents search on the user's "
+                             'time')
+    parser.add_argument('--book', required=False,
+                        help='Opening book to play from before searching, '
+                             'built with python -m chess.book')
     parser.add_argument("--kwarg", action='append',
                         type=lambda kv: kv.split("="), dest='kwargs',
                         default=[])
@@ -182,5 +237,10 @@ if __name__ == '__main__':
             agent = agent_class.from_file(args.savefile)
         else:
             agent = agent_class(**kwargs)
+        ponder = not args.no_ponder
+        if args.stats:
+            agent.stats = SearchStats(json_lines(args.stats))
+        if args.book:
+            agent = BookAgent(agent, OpeningBook(args.book))
 
         app.run(host='0.0.0.0', debug=True)
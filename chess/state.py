@@ -1,4 +1,5 @@
 import enum
+import itertools
 import random
 from typing import List, Tuple, Iterable, Union
 import numpy as np
@@ -128,6 +129,202 @@ for i in range(64):
     piece = 1 << i
     QUEEN_MOVES[piece] = BISHOP_MOVES[piece] | ROOK_MOVES[piece]
 
+# Slider attack tables: for every square, the relevant occupancy mask (the
+# ray squares that can block, i.e. excluding the board edge) and a dict
+# mapping each possible masked occupancy to the resulting attack set, so a
+# slider's attacks are a single lookup: table[occupancy & mask]. The dict
+# hash plays the role of the magic multiplication used by C engines.
+ROOK_DIRECTIONS = ((MASK_DOWN, -8), (MASK_UP, 8),
+                   (MASK_RIGHT, -1), (MASK_LEFT, 1))
+BISHOP_DIRECTIONS = ((MASK_DR, -9), (MASK_UL, 9),
+                     (MASK_DL, -7), (MASK_UR, 7))
+
+
+def _ray_attacks(piece: int, edge: int,
+                 shift: int) -> List[Tuple[int, int]]:
+    """
+    List (blocking occupancy, attacks) pairs for every occupancy of a single
+    ray starting next to piece
+    """
+    ray = []
+    current = piece
+    while current & ~edge:
+        current &= ~edge
+        current = current << shift if shift > 0 else current >> -shift
+        ray.append(current)
+    # Whatever stands on the last square of the ray, it is attacked, so it
+    # never changes the attack set
+    relevant = ray[:-1]
+    out = []
+    for n in range(1 << len(relevant)):
+        occupancy = 0
+        for j, square in enumerate(relevant):
+            if (n >> j) & 1:
+                occupancy |= square
+        attacks = 0
+        for square in ray:
+            attacks |= square
+            if square & occupancy:
+                break
+        out.append((occupancy, attacks))
+    return out
+
+
+def _slider_table(piece: int, directions) -> Tuple[int, dict]:
+    rays = [_ray_attacks(piece, edge, shift) for edge, shift in directions]
+    mask = 0
+    for ray in rays:
+        mask |= ray[-1][0]
+    # Rays are independent, so pair them up before taking the full product
+    first = [(o1 | o2, a1 | a2) for (o1, a1), (o2, a2) in
+             itertools.product(rays[0], rays[1])]
+    second = [(o1 | o2, a1 | a2) for (o1, a1), (o2, a2) in
+              itertools.product(rays[2], rays[3])]
+    # Many occupancies share an attack set; keep a single int for each
+    shared = {}
+    table = {o1 | o2: shared.setdefault(a1 | a2, a1 | a2)
+             for (o1, a1), (o2, a2) in itertools.product(first, second)}
+    return mask, table
+
+
+ROOK_TABLE = {}
+BISHOP_TABLE = {}
+for i in range(64):
+    piece = 1 << i
+    ROOK_TABLE[piece] = _slider_table(piece, ROOK_DIRECTIONS)
+    BISHOP_TABLE[piece] = _slider_table(piece, BISHOP_DIRECTIONS)
+
+
+# Squares strictly between two squares on the same rank, file or diagonal,
+# keyed by the union of the two squares
+BETWEEN = {}
+for i in range(64):
+    piece = 1 << i
+    for edge, shift in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+        between = 0
+        current = piece
+        while current & ~edge:
+            current &= ~edge
+            current = current << shift if shift > 0 else current >> -shift
+            BETWEEN[piece | current] = between
+            between |= current
+
+ALL_SQUARES = 0xffffffffffffffff
+
+# Zobrist keys: a position's key is the xor of the keys of its pieces (by
+# player, piece index and square), the side to move, each player's castling
+# right and the file of a pawn that can be taken en passant. A fixed seed
+# keeps keys stable between runs so they can be stored.
+_zobrist_random = random.Random(393)
+ZOBRIST_PIECES = tuple(
+    tuple({1 << i: _zobrist_random.getrandbits(64) for i in range(64)}
+          for _ in range(6))
+    for _ in range(2))
+ZOBRIST_BLACK_TURN = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLES = (_zobrist_random.getrandbits(64),
+                   _zobrist_random.getrandbits(64))
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]
+
+# Evaluation kept up to date by make_move: material plus a bonus for each
+# piece by square, in centipawns. Tables are seen from white's side and start
+# from a8, the way BOARD_INDEX counts; black uses them mirrored
+MATERIAL_VALUES = (100, 300, 300, 500, 1200, 0)
+PIECE_SQUARE_TABLES = (
+    (0, 0, 0, 0, 0, 0, 0, 0,  # pawns
+     50, 50, 50, 50, 50, 50, 50, 50,
+     10, 10, 20, 30, 30, 20, 10, 10,
+     5, 5, 10, 25, 25, 10, 5, 5,
+     0, 0, 0, 20, 20, 0, 0, 0,
+     5, -5, -10, 0, 0, -10, -5, 5,
+     5, 10, 10, -20, -20, 10, 10, 5,
+     0, 0, 0, 0, 0, 0, 0, 0),
+    (-50, -40, -30, -30, -30, -30, -40, -50,  # knights
+     -40, -20, 0, 0, 0, 0, -20, -40,
+     -30, 0, 10, 15, 15, 10, 0, -30,
+     -30, 5, 15, 20, 20, 15, 5, -30,
+     -30, 0, 15, 20, 20, 15, 0, -30,
+     -30, 5, 10, 15, 15, 10, 5, -30,
+     -40, -20, 0, 5, 5, 0, -20, -40,
+     -50, -40, -30, -30, -30, -30, -40, -50),
+    (-20, -10, -10, -10, -10, -10, -10, -20,  # bishops
+     -10, 0, 0, 0, 0, 0, 0, -10,
+     -10, 0, 5, 10, 10, 5, 0, -10,
+     -10, 5, 5, 10, 10, 5, 5, -10,
+     -10, 0, 10, 10, 10, 10, 0, -10,
+     -10, 10, 10, 10, 10, 10, 10, -10,
+     -10, 5, 0, 0, 0, 0, 5, -10,
+     -20, -10, -10, -10, -10, -10, -10, -20),
+    (0, 0, 0, 0, 0, 0, 0, 0,  # rooks
+     5, 10, 10, 10, 10, 10, 10, 5,
+     -5, 0, 0, 0, 0, 0, 0, -5,
+     -5, 0, 0, 0, 0, 0, 0, -5,
+     -5, 0, 0, 0, 0, 0, 0, -5,
+     -5, 0, 0, 0, 0, 0, 0, -5,
+     -5, 0, 0, 0, 0, 0, 0, -5,
+     0, 0, 0, 5, 5, 0, 0, 0),
+    (-20, -10, -10, -5, -5, -10, -10, -20,  # queens
+     -10, 0, 0, 0, 0, 0, 0, -10,
+     -10, 0, 5, 5, 5, 5, 0, -10,
+     -5, 0, 5, 5, 5, 5, 0, -5,
+     0, 0, 5, 5, 5, 5, 0, -5,
+     -10, 5, 5, 5, 5, 5, 0, -10,
+     -10, 0, 5, 0, 0, 0, 0, -10,
+     -20, -10, -10, -5, -5, -10, -10, -20),
+    (-30, -40, -40, -50, -50, -40, -40, -30,  # king
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -20, -30, -30, -40, -40, -30, -30, -20,
+     -10, -20, -20, -20, -20, -20, -20, -10,
+     20, 20, 0, 0, 0, 0, 20, 20,
+     20, 30, 10, 0, 0, 10, 30, 20),
+)
+# Score of each piece by player, piece index and square, counted for white,
+# so a position's score is the sum over its pieces
+PSQT = (
+    tuple({1 << i: value + table[63 - i] for i in range(64)}
+          for value, table in zip(MATERIAL_VALUES, PIECE_SQUARE_TABLES)),
+    tuple({1 << i: -value - table[(63 - i) ^ 56] for i in range(64)}
+          for value, table in zip(MATERIAL_VALUES, PIECE_SQUARE_TABLES)),
+)
+
+
+# Index of each square in the 64 square lists used by to_dict and __str__,
+# which start from the top left corner
+BOARD_INDEX = {1 << i: 63 - i for i in range(64)}
+
+
+def iter_bits(board: int) -> Iterable[int]:
+    """
+    Split a bitboard into its set bits, lowest first. x & -x isolates the
+    lowest bit, so this costs one step per piece instead of one per square
+    """
+    while board:
+        bit = board & -board
+        yield bit
+        board ^= bit
+
+
+def rook_attacks(piece: int, occupancy: int) -> int:
+    """
+    Squares attacked by a rook on piece, given the occupancy of the board
+    """
+    mask, table = ROOK_TABLE[piece]
+    return table[occupancy & mask]
+
+
+def bishop_attacks(piece: int, occupancy: int) -> int:
+    """
+    Squares attacked by a bishop on piece, given the occupancy of the board
+    """
+    mask, table = BISHOP_TABLE[piece]
+    return table[occupancy & mask]
+
+
+# Rough piece values by index, only used to order captures
+PIECE_VALUES = (1, 3, 3, 5, 9, 100)
+
+
 FILES = [
     0x8080808080808080,
     0x4040404040404040,
@@ -256,6 +453,13 @@ class State:
     """
     Class to represent the state of a board
     """
+    # Search keeps millions of these alive, so there is no per-instance dict
+    # and the move containers are only created when first used
+    __slots__ = ('white', 'black', 'white_pos', 'black_pos', 'white_turn',
+                 'prev_move', 'in_check', 'castles', 'can_castle', 'zobrist',
+                 'psqt', 'true_moves', 'fake_moves', 'children',
+                 'moves_complete', '_castle_moves', '_rook_castle_moves',
+                 '_en_passant_moves', '_attack_maps', '_safety')
 
     def __init__(self, white: Tuple[int, int, int, int, int, int] = None,
                  black: Tuple[int, int, int, int, int, int] = None,
@@ -271,27 +475,27 @@ class State:
                 'Please input one of ("w", "b") as the turn')
 
         self.prev_move = prev_move
-        self.white = white
-        self.black = black
-
-        self.true_moves = None
-        self.fake_moves = None
         self.in_check = in_check
 
-        if self.white is None:
-            self.white = (kwargs.get('wp', 0x000000000000ff00),  # pawns
+        # Bitboards are kept in lists so make_move can update them in place
+        if white is None:
+            self.white = [kwargs.get('wp', 0x000000000000ff00),  # pawns
                           kwargs.get('wn', 0x0000000000000042),  # knights
                           kwargs.get('wb', 0x0000000000000024),  # bishops
                           kwargs.get('wr', 0x0000000000000081),  # rooks
                           kwargs.get('wq', 0x0000000000000010),  # queen
-                          kwargs.get('wk', 0x0000000000000008))  # king
-        if self.black is None:
-            self.black = (kwargs.get('bp', 0x00ff000000000000),  # pawns
+                          kwargs.get('wk', 0x0000000000000008)]  # king
+        else:
+            self.white = list(white)
+        if black is None:
+            self.black = [kwargs.get('bp', 0x00ff000000000000),  # pawns
                           kwargs.get('bk', 0x4200000000000000),  # knights
                           kwargs.get('bb', 0x2400000000000000),  # bishops
                           kwargs.get('br', 0x8100000000000000),  # rooks
                           kwargs.get('bq', 0x1000000000000000),  # queen
-                          kwargs.get('bk', 0x0800000000000000))  # king
+                          kwargs.get('bk', 0x0800000000000000)]  # king
+        else:
+            self.black = list(black)
         # Make sure board layout is valid (no overlap)
         self.white_pos = 0
         for e in self.white:
@@ -312,11 +516,70 @@ class State:
         else:
             self.can_castle = self.castles[1]
         self.can_castle = self.can_castle and not self.in_check
-        self.castle_moves = []
-        self.rook_castle_moves = []
+        self.zobrist = self.compute_zobrist()
+        self.psqt = self.compute_psqt()
+        self._clear_moves()
+
+    def _clear_moves(self) -> None:
+        """
+        Forget the move lists cached for the current position
+        """
+        self.true_moves = None
+        self.fake_moves = None
         self.children = None
         self.moves_complete = False
-        self.en_passant_moves = set()
+        self._castle_moves = None
+        self._rook_castle_moves = None
+        self._en_passant_moves = None
+        self._attack_maps = None
+        self._safety = None
+
+    @property
+    def castle_moves(self) -> List[Tuple[int, int]]:
+        """
+        King moves found to be castles while listing pseudolegal moves
+        """
+        if self._castle_moves is None:
+            self._castle_moves = []
+        return self._castle_moves
+
+    @property
+    def rook_castle_moves(self) -> List[Tuple[int, int]]:
+        """
+        Rook moves matching each entry of castle_moves
+        """
+        if self._rook_castle_moves is None:
+            self._rook_castle_moves = []
+        return self._rook_castle_moves
+
+    @property
+    def en_passant_moves(self) -> set:
+        """
+        Pawn moves found to be en passant captures while listing pseudolegal
+        moves
+        """
+        if self._en_passant_moves is None:
+            self._en_passant_moves = set()
+        return self._en_passant_moves
+
+    def copy(self) -> 'State':
+        """
+        Copy the position, without any of the cached move lists
+        """
+        new_state = State.__new__(State)
+        new_state.white = self.white[:]
+        new_state.black = self.black[:]
+        new_state.white_pos = self.white_pos
+        new_state.black_pos = self.black_pos
+        new_state.white_turn = self.white_turn
+        new_state.prev_move = self.prev_move
+        new_state.in_check = self.in_check
+        new_state.castles = self.castles
+        new_state.can_castle = self.can_castle
+        new_state.zobrist = self.zobrist
+        new_state.psqt = self.psqt
+        new_state._clear_moves()
+        return new_state
 
     def list_moves(self) -> List[Tuple[int, int]]:
         """
@@ -330,22 +593,378 @@ class State:
             self.white, self.black) if self.white_turn else (
             self.black, self.white)
         out = []
-        for ix, pieces in enumerate(current_player):
-            m = 1 << 63
-            while m > 0:
-                tmp = pieces & m
-                if tmp:
-                    move = (m, self.get_moves(m))
-                    out.append(move)
-                m >>= 1
+        for pieces in current_player:
+            while pieces:
+                piece = pieces & -pieces
+                pieces ^= piece
+                out.append((piece, self.get_moves(piece)))
         self.fake_moves = out
         return out
 
     def list_legal_moves(self) -> List[Tuple[int, int]]:
-        if not self.moves_complete:
-            list(self.get_children())
+        """
+        Lists all legal moves
+        """
+        if self.true_moves is None:
+            self.true_moves = self._generate_legal()
         return self.true_moves
 
+    def staged_moves(self, hash_move: Tuple[int, int] = None,
+                     killers: Iterable[Tuple[int, int]] = (),
+                     history: dict = None, mvv_lva: bool = True,
+                     quiets: bool = True) -> Iterable[Tuple[int, int]]:
+        """
+        Generate legal moves in the order a search wants to try them: the hash
+        move, then captures and promotions that don't lose material, best
+        victim and cheapest attacker first, then killer moves, then the other
+        quiet moves, then captures of defended pieces by more valuable ones.
+        Each stage is only generated once the previous one has been used up,
+        so a cutoff on an early move saves generating the rest
+        Params:
+        ------
+        hash_move: Tuple[int, int]
+            Move to try first, e.g. the best move found by an earlier search.
+            Skipped if it isn't legal here
+        killers: Iterable[Tuple[int, int]]
+            Quiet moves that caused cutoffs in sibling positions, tried before
+            the other quiet moves if they are legal here
+        history: dict
+            Score of each quiet move, quiet moves are tried highest first.
+            None leaves them in generation order
+        mvv_lva: bool
+            Order captures by victim and attacker value, and leave losing ones
+            for last. Otherwise they come in generation order
+        quiets: bool
+            Include quiet moves, otherwise only captures and promotions (and
+            the hash move) are generated
+        Returns:
+        ------
+        Iterable[Tuple[int, int]]:
+            Every legal move exactly once
+        """
+        white_turn = self.white_turn
+        if white_turn:
+            me, them, them_pos = self.white, self.black, self.black_pos
+            last_rank = RANKS[7]
+        else:
+            me, them, them_pos = self.black, self.white, self.white_pos
+            last_rank = RANKS[0]
+
+        if hash_move is not None:
+            if hash_move in self._generate_legal(hash_move[1]):
+                yield hash_move
+            else:
+                hash_move = None
+
+        en_passant = self._en_passant_target()
+        pawns = me[0]
+        good = []
+        bad = []
+        for move in self._generate_legal(them_pos | en_passant | last_rank):
+            piece, target = move
+            if move == hash_move:
+                continue
+            attacker = 0
+            while not me[attacker] & piece:
+                attacker += 1
+            if target & them_pos:
+                victim = 0
+                while not them[victim] & target:
+                    victim += 1
+                gain = PIECE_VALUES[victim]
+            elif piece & pawns:  # en passant or a quiet promotion
+                gain = PIECE_VALUES[0] if target & en_passant else 0
+            else:  # a quiet move that happens to land on the last rank
+                continue
+            if not mvv_lva:
+                good.append((0, move))
+                continue
+            if piece & pawns and target & last_rank:
+                gain += PIECE_VALUES[4] - PIECE_VALUES[0]
+            score = 16 * gain - PIECE_VALUES[attacker]
+            if gain < PIECE_VALUES[attacker] and \
+                    self.attack_map(not white_turn) & target:
+                bad.append((score, move))
+            else:
+                good.append((score, move))
+        if mvv_lva:
+            good.sort(reverse=True)
+        for _, move in good:
+            yield move
+
+        # Pawn moves onto the last rank or the en passant square were all
+        # taken in the first stage, other pieces only move there quietly
+        noisy = last_rank | en_passant
+        tried = [hash_move]
+        for killer in killers if quiets else ():
+            if killer not in tried and not killer[1] & them_pos and not (
+                    killer[0] & pawns and killer[1] & noisy) and \
+                    self._is_legal_quiet(*killer):
+                tried.append(killer)
+                yield killer
+
+        if quiets:
+            moves = [move for move in
+                     self._generate_legal(~them_pos & ALL_SQUARES)
+                     if move not in tried and not (move[0] & pawns and
+                                                   move[1] & noisy)]
+            if history:
+                moves.sort(key=lambda move: history.get(move, 0),
+                           reverse=True)
+            yield from moves
+
+        bad.sort(reverse=True)
+        for _, move in bad:
+            yield move
+
+    def _is_legal_quiet(self, piece: int, target: int) -> bool:
+        """
+        Check a move that captures nothing, like a killer move from another
+        position, against the masks of _king_safety instead of generating
+        every move. Only castling, which is rare, falls back to generating
+        the king's moves
+        Params:
+        ------
+        piece: int
+            Square the move starts on
+        target: int
+            Square the move ends on
+        Returns:
+        ------
+        bool:
+            True if the move is legal and isn't a capture, en passant
+            included
+        """
+        white_turn = self.white_turn
+        if white_turn:
+            me, me_pos = self.white, self.white_pos
+        else:
+            me, me_pos = self.black, self.black_pos
+        occupancy = self.white_pos | self.black_pos
+        if target & occupancy or not piece & me_pos:
+            return False
+        danger, check_mask, pinned, pin_rays = self._king_safety()
+        if piece == me[5]:
+            if KING_MOVES[piece] & target:
+                return not target & danger
+            return (piece, target) in self._generate_legal(target)
+        if not target & check_mask or \
+                piece & pinned and not target & pin_rays[piece]:
+            return False
+        if piece & me[0]:
+            if white_turn:
+                step, double, start = piece << 8, piece << 16, RANKS[1]
+            else:
+                step, double, start = piece >> 8, piece >> 16, RANKS[6]
+            return target == step or target == double and \
+                piece & start != 0 and not occupancy & step
+        if piece & me[1]:
+            return KNIGHT_MOVES[piece] & target != 0
+        targets = 0
+        if piece & (me[2] | me[4]):
+            mask, table = BISHOP_TABLE[piece]
+            targets = table[occupancy & mask]
+        if piece & (me[3] | me[4]):
+            mask, table = ROOK_TABLE[piece]
+            targets |= table[occupancy & mask]
+        return targets & target != 0
+
+    def _generate_legal(self, target_mask: int = ALL_SQUARES) \
+            -> List[Tuple[int, int]]:
+        """
+        Generate the legal moves landing on target_mask. Checkers, pinned
+        pieces and the squares attacked around the king come from
+        _king_safety, so no move has to be tried out on the board
+        Params:
+        ------
+        target_mask: int
+            Bitboard of destinations to generate moves to
+        Returns:
+        ------
+        List[Tuple[int, int]]:
+            Legal (piece, target) moves
+        """
+        white_turn = self.white_turn
+        if white_turn:
+            me, them = self.white, self.black
+            me_pos, them_pos = self.white_pos, self.black_pos
+        else:
+            me, them = self.black, self.white
+            me_pos, them_pos = self.black_pos, self.white_pos
+        occupancy = me_pos | them_pos
+        allowed = target_mask & ~me_pos
+        out = []
+
+        king = me[5]
+        danger, check_mask, pinned, pin_rays = self._king_safety()
+        if king:
+            targets = KING_MOVES[king] & allowed & ~danger
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                out.append((king, target))
+            if not check_mask:  # double check, only king moves
+                return out
+            if check_mask == ALL_SQUARES and \
+                    self.castles[0 if white_turn else 1] and \
+                    king == (0x8 if white_turn else 0x8 << 56):
+                if me[3] & (king >> 3) and not occupancy & (
+                        (king >> 1) | (king >> 2)) and not danger & (
+                        (king >> 1) | (king >> 2)) and target_mask & (
+                        king >> 2):
+                    out.append((king, king >> 2))
+                if me[3] & (king << 4) and not occupancy & (
+                        (king << 1) | (king << 2) | (king << 3)) and \
+                        not danger & ((king << 1) | (king << 2)) and \
+                        target_mask & (king << 2):
+                    out.append((king, king << 2))
+            allowed &= check_mask
+
+        # Pieces and targets are taken lowest bit first with x & -x, so the
+        # loops only run once per piece or move
+        empty = ~occupancy
+        pieces = me[0]
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            if white_turn:
+                targets = (piece << 8) & empty
+                if targets and piece & RANKS[1]:
+                    targets |= (piece << 16) & empty
+                targets |= (((piece & ~MASK_LEFT) << 9) |
+                            ((piece & ~MASK_RIGHT) << 7)) & them_pos
+            else:
+                targets = (piece >> 8) & empty
+                if targets and piece & RANKS[6]:
+                    targets |= (piece >> 16) & empty
+                targets |= (((piece & ~MASK_RIGHT) >> 9) |
+                            ((piece & ~MASK_LEFT) >> 7)) & them_pos
+            targets &= allowed
+            if piece & pinned:
+                targets &= pin_rays[piece]
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                out.append((piece, target))
+        pieces = me[1] & ~pinned
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            targets = KNIGHT_MOVES[piece] & allowed
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                out.append((piece, target))
+        pieces = me[2] | me[3] | me[4]
+        bishops = me[2] | me[4]
+        rooks = me[3] | me[4]
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            targets = 0
+            if piece & bishops:
+                mask, table = BISHOP_TABLE[piece]
+                targets = table[occupancy & mask]
+            if piece & rooks:
+                mask, table = ROOK_TABLE[piece]
+                targets |= table[occupancy & mask]
+            targets &= allowed
+            if piece & pinned:
+                targets &= pin_rays[piece]
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                out.append((piece, target))
+
+        # En passant also removes the captured pawn, which can uncover the
+        # king along the rank both pawns leave, so sliders are looked up again
+        # with the board as it would be after the capture
+        target = self._en_passant_target()
+        if target & target_mask:
+            pawn = target >> 8 if white_turn else target << 8
+            if check_mask & (target | pawn):
+                for piece in iter_bits((((pawn & ~MASK_LEFT) << 1) |
+                                        ((pawn & ~MASK_RIGHT) >> 1)) & me[0]):
+                    after = occupancy ^ piece ^ target ^ pawn
+                    if not king or not (
+                            rook_attacks(king, after) & (them[3] | them[4]) or
+                            bishop_attacks(king, after) & (
+                                them[2] | them[4])):
+                        out.append((piece, target))
+        return out
+
+    def _king_safety(self) -> Tuple[int, int, int, dict]:
+        """
+        Work out what constrains the side to move's king, cached until the
+        position changes so every stage of staged_moves can share it
+        Returns:
+        ------
+        Tuple[int, int, int, dict]:
+            Squares the king can't step to, squares other pieces must move to
+            (every square if not in check, none in double check), pinned
+            pieces, and the ray each pinned piece is confined to
+        """
+        if self._safety is not None:
+            return self._safety
+        white_turn = self.white_turn
+        if white_turn:
+            me, them = self.white, self.black
+            me_pos, them_pos = self.white_pos, self.black_pos
+        else:
+            me, them = self.black, self.white
+            me_pos, them_pos = self.black_pos, self.white_pos
+        occupancy = me_pos | them_pos
+        king = me[5]
+        if not king:
+            self._safety = (0, ALL_SQUARES, 0, None)
+            return self._safety
+
+        # The king can't hide behind itself from a slider, so it is removed
+        # from the occupancy when finding the attacked squares
+        danger = self._compute_attack_map(not white_turn, occupancy & ~king)
+        checkers = self.attackers_to(king, not white_turn, occupancy)
+        if checkers & (checkers - 1):
+            check_mask = 0
+        elif checkers:
+            check_mask = checkers | BETWEEN.get(king | checkers, 0)
+        else:
+            check_mask = ALL_SQUARES
+
+        # A piece is pinned if it is the only piece between the king and an
+        # enemy slider that sees the king through our own pieces
+        pinned = 0
+        pin_rays = None
+        pinners = (rook_attacks(king, them_pos) & (them[3] | them[4])) | \
+                  (bishop_attacks(king, them_pos) & (them[2] | them[4]))
+        while pinners:
+            pinner = pinners & -pinners
+            pinners ^= pinner
+            ray = BETWEEN[king | pinner]
+            blockers = ray & occupancy
+            if blockers and not blockers & (blockers - 1):
+                pinned |= blockers
+                if pin_rays is None:
+                    pin_rays = {}
+                pin_rays[blockers] = ray | pinner
+        self._safety = (danger, check_mask, pinned, pin_rays)
+        return self._safety
+
+    def _en_passant_target(self) -> int:
+        """
+        Square the side to move can capture onto en passant, or 0
+        """
+        prev_move = self.prev_move
+        if prev_move is None:
+            return 0
+        if self.white_turn:
+            if prev_move[1] & self.black[0] and \
+                    prev_move[0] == prev_move[1] << 16:
+                return prev_move[1] << 8
+        elif prev_move[1] & self.white[0] and \
+                prev_move[0] == prev_move[1] >> 16:
+            return prev_move[1] >> 8
+        return 0
+
     def get_moves(self, piece: int) -> int:
         """
         List the moves of a specific piece (specified by bitboard)
@@ -412,8 +1031,9 @@ class State:
                 out |= (piece << 9)
             if ((piece & ~MASK_RIGHT) << 7) & black_pos:
                 out |= (piece << 7)
-            # En Passant
-            if self.prev_move is not None:
+            # En Passant, only right after a double pawn push
+            if self.prev_move is not None and \
+                    self.prev_move[0] == self.prev_move[1] << 16:
                 left_prev_pawn = ((self.black[0] & self.prev_move[1]
                                    & 0xFF00000000)
                                   & ((piece & ~MASK_LEFT) << 1)) != 0
@@ -444,8 +1064,9 @@ class State:
                 tmp = piece >> 7
                 out |= tmp
 
-            # En Passant
-            if self.prev_move is not None:
+            # En Passant, only right after a double pawn push
+            if self.prev_move is not None and \
+                    self.prev_move[0] == self.prev_move[1] >> 16:
                 left_prev_pawn = ((self.white[0] & self.prev_move[
                     1] & 0xFF000000)
                                   & ((piece & ~MASK_LEFT) << 1)) != 0
@@ -471,10 +1092,12 @@ class State:
                 castle_queen = piece << 2
                 pseudo_can_castle_king = ((self.white_pos | self.black_pos)
                                           & (0x2 | 0x4)) == 0 and \
-                                         (self.white[3] & 0x1) != 0
+                                         (self.white[3] & 0x1) != 0 and \
+                                         not self.is_attacked(0x4, False)
                 pseudo_can_castle_queen = ((self.white_pos | self.black_pos)
                                            & (0x10 | 0x20 | 0x40)) == 0 and \
-                                          (self.white[3] & 0x80) != 0
+                                          (self.white[3] & 0x80) != 0 and \
+                                          not self.is_attacked(0x10, False)
                 if pseudo_can_castle_king:
                     tmp |= castle_king
                     self.castle_moves.append((piece, castle_king))
@@ -490,11 +1113,15 @@ class State:
                 castle_queen = piece << 2
                 pseudo_can_castle_king = (((self.white_pos | self.black_pos) &
                                            ((0x2 | 0x4) << 56)) == 0) and \
-                                         (self.black[3] & (0x1 << 56)) != 0
+                                         (self.black[3] & (0x1 << 56)) != 0 \
+                                         and not self.is_attacked(0x4 << 56,
+                                                                  True)
                 pseudo_can_castle_queen = ((self.white_pos | self.black_pos)
                                            & (((0x10 << 56) | (0x20 << 56) |
                                                (0x40 << 56)))) == 0 and \
-                                          (self.black[3] & (0x80 << 56)) != 0
+                                          (self.black[3] & (0x80 << 56)) != 0 \
+                                          and not self.is_attacked(0x10 << 56,
+                                                                   True)
 
                 if pseudo_can_castle_king:
                     tmp |= castle_king
@@ -509,78 +1136,14 @@ class State:
         return tmp
 
     def rook_moves(self, piece: int) -> int:
-        white_pos, black_pos = self.white_pos & ~piece, self.black_pos & ~piece
-
-        moves = 0
-        if self.white_turn:
-            opponent = black_pos
-        else:
-            opponent = white_pos
-
-        # Down
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_DOWN) >> 8
-        moves |= current_ray & opponent
-
-        # Up
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_UP) << 8
-        moves |= current_ray & opponent
-
-        # Left
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_RIGHT) >> 1
-        moves |= current_ray & opponent
-
-        # Right
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_LEFT) << 1
-        moves |= current_ray & opponent
-
-        return moves & ~piece
+        mask, table = ROOK_TABLE[piece]
+        own = self.white_pos if self.white_turn else self.black_pos
+        return table[(self.white_pos | self.black_pos) & mask] & ~own
 
     def bishop_moves(self, piece: int) -> int:
-        white_pos, black_pos = self.white_pos & ~piece, self.black_pos & ~piece
-        moves = 0
-        opponent = black_pos if self.white_turn else white_pos
-
-        # Down Right
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_DR) >> 9
-        moves |= current_ray & opponent
-
-        # Up Left
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_UL) << 9
-        moves |= current_ray & opponent
-
-        # Down Left
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_DL) >> 7
-        moves |= current_ray & opponent
-
-        # Up Right
-        current_ray = piece
-        while current_ray & ~(black_pos | white_pos):
-            moves |= current_ray
-            current_ray = (current_ray & ~MASK_UR) << 7
-        moves |= current_ray & opponent
-
-        return moves & ~piece
+        mask, table = BISHOP_TABLE[piece]
+        own = self.white_pos if self.white_turn else self.black_pos
+        return table[(self.white_pos | self.black_pos) & mask] & ~own
 
     def queen_moves(self, piece: int) -> int:
         return self.rook_moves(piece) | self.bishop_moves(piece)
@@ -697,11 +1260,7 @@ class State:
         :param piece:
         :return:
         """
-        m = 1 << 63
-        while m > 0:
-            if m & piece:
-                yield m
-            m >>= 1
+        return iter_bits(piece)
 
     def is_pseudolegal(self, piece: int, target: int) -> bool:
         """
@@ -718,7 +1277,8 @@ class State:
             True if move is legal else False
         """
         return (self.get_moves(piece) & target) != 0 \
-               or (piece, target) in self.castle_moves
+               or (self._castle_moves is not None and
+                   (piece, target) in self._castle_moves)
 
     def find_ix(self, piece: int):
         for i in range(6):
@@ -727,6 +1287,334 @@ class State:
             if self.black[i] & piece != 0:
                 return i
 
+    def attackers_to(self, square: int, white: bool,
+                     occupancy: int = None) -> int:
+        """
+        Find the pieces of one side attacking a square. Each piece's move
+        table is looked up from the square itself and matched against the
+        pieces of that type, so no moves have to be generated
+        Params:
+        ------
+        square: int
+            Bitboard of a single square
+        white: bool
+            Side whose attackers to find
+        occupancy: int
+            Pieces blocking sliders, by default every piece on the board
+        Returns:
+        ------
+        int:
+            Bitboard of the attacking pieces
+        """
+        if occupancy is None:
+            occupancy = self.white_pos | self.black_pos
+        attacker = self.white if white else self.black
+        if white:
+            pawns = ((square & ~MASK_RIGHT) >> 9) | ((square & ~MASK_LEFT) >> 7)
+        else:
+            pawns = ((square & ~MASK_LEFT) << 9) | ((square & ~MASK_RIGHT) << 7)
+        mask, table = ROOK_TABLE[square]
+        out = table[occupancy & mask] & (attacker[3] | attacker[4])
+        mask, table = BISHOP_TABLE[square]
+        out |= table[occupancy & mask] & (attacker[2] | attacker[4])
+        return out | (KNIGHT_MOVES[square] & attacker[1]) | (
+            KING_MOVES[square] & attacker[5]) | (pawns & attacker[0])
+
+    def is_attacked(self, square: int, by_white: bool = None) -> bool:
+        """
+        Check whether a square is attacked
+        Params:
+        ------
+        square: int
+            Bitboard of a single square
+        by_white: bool
+            Side attacking the square, by default the side not to move
+        """
+        if by_white is None:
+            by_white = not self.white_turn
+        if self._attack_maps is not None:
+            attacks = self._attack_maps[0 if by_white else 1]
+            if attacks is not None:
+                return (attacks & square) != 0
+        attacker = self.white if by_white else self.black
+        if KNIGHT_MOVES[square] & attacker[1] or \
+                KING_MOVES[square] & attacker[5]:
+            return True
+        if by_white:
+            pawns = ((square & ~MASK_RIGHT) >> 9) | ((square & ~MASK_LEFT) >> 7)
+        else:
+            pawns = ((square & ~MASK_LEFT) << 9) | ((square & ~MASK_RIGHT) << 7)
+        if pawns & attacker[0]:
+            return True
+        occupancy = self.white_pos | self.black_pos
+        mask, table = ROOK_TABLE[square]
+        if table[occupancy & mask] & (attacker[3] | attacker[4]):
+            return True
+        mask, table = BISHOP_TABLE[square]
+        return (table[occupancy & mask] & (attacker[2] | attacker[4])) != 0
+
+    def attack_map(self, white: bool) -> int:
+        """
+        Bitboard of every square attacked by one side, cached until the
+        position changes
+        """
+        if self._attack_maps is None:
+            self._attack_maps = [None, None]
+        ix = 0 if white else 1
+        if self._attack_maps[ix] is None:
+            self._attack_maps[ix] = self._compute_attack_map(
+                white, self.white_pos | self.black_pos)
+        return self._attack_maps[ix]
+
+    def _compute_attack_map(self, white: bool, occupancy: int) -> int:
+        attacker = self.white if white else self.black
+        pawns = attacker[0]
+        if white:
+            out = ((pawns & ~MASK_LEFT) << 9) | ((pawns & ~MASK_RIGHT) << 7)
+        else:
+            out = ((pawns & ~MASK_RIGHT) >> 9) | ((pawns & ~MASK_LEFT) >> 7)
+        pieces = attacker[1]
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            out |= KNIGHT_MOVES[piece]
+        pieces = attacker[2] | attacker[4]
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            mask, table = BISHOP_TABLE[piece]
+            out |= table[occupancy & mask]
+        pieces = attacker[3] | attacker[4]
+        while pieces:
+            piece = pieces & -pieces
+            pieces ^= piece
+            mask, table = ROOK_TABLE[piece]
+            out |= table[occupancy & mask]
+        if attacker[5]:
+            out |= KING_MOVES[attacker[5]]
+        return out & ALL_SQUARES
+
+    def make_move(self, move: Tuple[int, int], promotion_ix: int = 4) -> tuple:
+        """
+        Make a move in place, without checking that it is legal
+        Params:
+        ------
+        move: Tuple[int, int]
+            Piece to move and its destination
+        promotion_ix: int
+            Piece to promote to, if the move is a promotion
+        Returns:
+        ------
+        tuple:
+            Undo information to pass to unmake_move
+        """
+        piece, target = move
+        white_turn = self.white_turn
+        if white_turn:
+            me, them = self.white, self.black
+            me_pos, them_pos = self.white_pos, self.black_pos
+        else:
+            me, them = self.black, self.white
+            me_pos, them_pos = self.black_pos, self.white_pos
+
+        for ix in range(6):
+            if me[ix] & piece:
+                break
+        else:
+            raise NoSuchPieceException(
+                f'No {"white" if white_turn else "black"} piece at {piece}')
+        key = self.zobrist ^ self._en_passant_key() ^ ZOBRIST_BLACK_TURN
+
+        captured = -1
+        captured_square = target
+        if target & them_pos:
+            for captured in range(6):
+                if them[captured] & target:
+                    break
+            them[captured] &= ~target
+        me[ix] ^= piece | target
+        me_pos ^= piece | target
+
+        promoted = ix
+        rook_move = None
+        if ix == 0:
+            if target & (RANKS[0] | RANKS[7]):
+                me[0] &= ~target
+                me[promotion_ix] |= target
+                promoted = promotion_ix
+            elif captured < 0 and (target == piece << 7 or
+                                   target == piece << 9 or
+                                   target == piece >> 7 or
+                                   target == piece >> 9):
+                # En passant: a diagonal pawn move to an empty square
+                captured = 0
+                captured_square = target >> 8 if white_turn else target << 8
+                them[0] &= ~captured_square
+        elif ix == 5 and (target == piece >> 2 or target == piece << 2):
+            if target < piece:  # king side castle
+                rook_move = (piece >> 3, piece >> 1)
+            else:  # queen side castle
+                rook_move = (piece << 4, piece << 1)
+            me[3] ^= rook_move[0] | rook_move[1]
+            me_pos ^= rook_move[0] | rook_move[1]
+        me_keys = ZOBRIST_PIECES[0 if white_turn else 1]
+        key ^= me_keys[ix][piece] ^ me_keys[promoted][target]
+        me_scores = PSQT[0 if white_turn else 1]
+        score = self.psqt + me_scores[promoted][target] - \
+            me_scores[ix][piece]
+        if captured >= 0:
+            them_pos &= ~captured_square
+            key ^= ZOBRIST_PIECES[1 if white_turn else 0][captured][
+                captured_square]
+            score -= PSQT[1 if white_turn else 0][captured][captured_square]
+        if rook_move is not None:
+            key ^= me_keys[3][rook_move[0]] ^ me_keys[3][rook_move[1]]
+            score += me_scores[3][rook_move[1]] - me_scores[3][rook_move[0]]
+
+        undo = (piece, target, ix, promoted, captured, captured_square,
+                rook_move, self.prev_move, self.castles, self.can_castle,
+                self.in_check, self.zobrist, self.psqt)
+        self.psqt = score
+
+        if white_turn:
+            self.white_pos, self.black_pos = me_pos, them_pos
+            if ix == 5 and self.castles[0]:
+                self.castles = (False, self.castles[1])
+                key ^= ZOBRIST_CASTLES[0]
+        else:
+            self.black_pos, self.white_pos = me_pos, them_pos
+            if ix == 5 and self.castles[1]:
+                self.castles = (self.castles[0], False)
+                key ^= ZOBRIST_CASTLES[1]
+        self.prev_move = move
+        self.white_turn = not white_turn
+        self.zobrist = key ^ self._en_passant_key()
+        # The attack maps cached for the previous position are stale now
+        self._clear_moves()
+        self.in_check = them[5] != 0 and self.is_attacked(them[5], white_turn)
+        self.can_castle = self.castles[white_turn] and not self.in_check
+        return undo
+
+    def _en_passant_key(self) -> int:
+        """
+        Zobrist key for the file of a pawn that can be taken en passant, only
+        counted when a pawn is next to it so transpositions still match
+        """
+        if self.prev_move is None:
+            return 0
+        piece, target = self.prev_move
+        if self.white_turn:
+            if piece != target << 16 or not target & self.black[0]:
+                return 0
+            pawns = self.white[0]
+        else:
+            if piece != target >> 16 or not target & self.white[0]:
+                return 0
+            pawns = self.black[0]
+        if (((target & ~MASK_LEFT) << 1) | ((target & ~MASK_RIGHT) >> 1)) & \
+                pawns:
+            return ZOBRIST_EN_PASSANT[(target.bit_length() - 1) & 7]
+        return 0
+
+    def compute_zobrist(self) -> int:
+        """
+        Compute the Zobrist key of the position from scratch. make_move keeps
+        the zobrist attribute up to date incrementally, so this is only
+        needed for new positions and for checking the incremental key
+        """
+        key = 0
+        for keys, player in zip(ZOBRIST_PIECES, (self.white, self.black)):
+            for ix, pieces in enumerate(player):
+                for piece in iter_bits(pieces):
+                    key ^= keys[ix][piece]
+        if not self.white_turn:
+            key ^= ZOBRIST_BLACK_TURN
+        for castles, castle_key in zip(self.castles, ZOBRIST_CASTLES):
+            if castles:
+                key ^= castle_key
+        return key ^ self._en_passant_key()
+
+    def compute_psqt(self) -> int:
+        """
+        Compute the material and piece-square score of the position from
+        scratch, in centipawns for white. make_move keeps the psqt attribute
+        up to date incrementally, so this is only needed for new positions
+        and for checking the incremental score
+        """
+        score = 0
+        for scores, player in zip(PSQT, (self.white, self.black)):
+            for ix, pieces in enumerate(player):
+                table = scores[ix]
+                for piece in iter_bits(pieces):
+                    score += table[piece]
+        return score
+
+    def unmake_move(self, undo: tuple) -> None:
+        """
+        Take back a move made with make_move
+        Params:
+        ------
+        undo: tuple
+            Value returned by make_move
+        """
+        piece, target, ix, promoted, captured, captured_square, rook_move, \
+            self.prev_move, self.castles, self.can_castle, \
+            self.in_check, self.zobrist, self.psqt = undo
+        white_turn = not self.white_turn
+        self.white_turn = white_turn
+        if white_turn:
+            me, them = self.white, self.black
+            me_pos, them_pos = self.white_pos, self.black_pos
+        else:
+            me, them = self.black, self.white
+            me_pos, them_pos = self.black_pos, self.white_pos
+
+        me[promoted] &= ~target
+        me[ix] |= piece
+        me_pos = (me_pos & ~target) | piece
+        if rook_move is not None:
+            me[3] ^= rook_move[0] | rook_move[1]
+            me_pos ^= rook_move[0] | rook_move[1]
+        if captured >= 0:
+            them[captured] |= captured_square
+            them_pos |= captured_square
+
+        if white_turn:
+            self.white_pos, self.black_pos = me_pos, them_pos
+        else:
+            self.black_pos, self.white_pos = me_pos, them_pos
+        self._clear_moves()
+
+    def make_null_move(self) -> tuple:
+        """
+        Pass the turn to the other side without moving, for null move
+        pruning. Only valid when the side to move is not in check
+        Returns:
+        ------
+        tuple:
+            Undo information to pass to unmake_null_move
+        """
+        undo = (self.prev_move, self.can_castle, self.zobrist)
+        # No pawn can be taken en passant after a pass
+        self.zobrist ^= self._en_passant_key() ^ ZOBRIST_BLACK_TURN
+        self.white_turn = not self.white_turn
+        self.prev_move = None
+        self.can_castle = self.castles[not self.white_turn]
+        self._clear_moves()
+        return undo
+
+    def unmake_null_move(self, undo: tuple) -> None:
+        """
+        Take back a pass made with make_null_move
+        Params:
+        ------
+        undo: tuple
+            Value returned by make_null_move
+        """
+        self.prev_move, self.can_castle, self.zobrist = undo
+        self.white_turn = not self.white_turn
+        self._clear_moves()
+
     def get_child(self, piece: int, target: int,
                   promotion_ix: int = 4) -> 'State':
         """
@@ -748,102 +1636,15 @@ class State:
             raise IllegalMoveException('Completely and utterly illegal move')
         if not 0 < promotion_ix < 5:
             raise IllegalMoveException('Cannot promote to such a piece')
-        castling = (piece, target) in self.castle_moves
-        en_passant = (piece, target) in self.en_passant_moves
-
-        if castling:
-            rook, rook_target = self.rook_castle_moves[
-                self.castle_moves.index((piece, target))]
-
-        ix = self.find_ix(piece)
-        promoting = (ix == 0) and (target & ((0xFF << 56) | 0xff)) != 0
-
-        if self.white_turn:
-            me = self.white
-            them = self.black
-        else:
-            me = self.black
-            them = self.white
-
-        if castling:
-            if target > me[-1]:  # queen side castle
-                self.get_child(me[-1], me[-1] << 1)
-            else:  # king side castle
-                self.get_child(me[-1], me[-1] >> 1)
-
-        tmp_white = self.white
-        tmp_black = self.black
-        tmp_white_pos = self.white_pos
-        tmp_black_pos = self.black_pos
-
-        assert target == (1 << (target.bit_length() - 1))
-
-        new_me = list(me)
-        new_me[ix] = (new_me[ix] & ~piece) | target
-        new_them = [i & ~target for i in them]
-
-        if castling:
-            new_me[3] = (new_me[3] & ~rook) | rook_target
-        if en_passant:
-            if self.white_turn:
-                new_them[0] &= ~(target >> 8)
-            else:
-                new_them[0] &= ~(target << 8)
-        if promoting:
-            new_me[promotion_ix] |= target
-            new_me[ix] = new_me[ix] & (~target)
-
-        new_me = tuple(new_me)
-        new_them = tuple(new_them)
-        me_king = new_me[-1]
-
-        if self.white_turn:
-            new_white = new_me
-        else:
-            new_white = new_them
-
-        if not self.white_turn:
-            new_black = new_me
-        else:
-            new_black = new_them
-
-        if self.white_turn:
-            new_can_castle = ((ix != 5) and self.castles[0], self.castles[1])
-            new_state = State(new_white, new_black, 'b',
-                              prev_move=(piece, target),
-                              can_castle=new_can_castle)
-        else:
-            new_can_castle = (self.castles[0], (ix != 5) and self.castles[1])
-            new_state = State(new_white, new_black, 'w',
-                              prev_move=(piece, target),
-                              can_castle=new_can_castle)
-
-        self.white = new_white
-        self.black = new_black
-        self.black_pos = new_state.black_pos
-        self.white_pos = new_state.white_pos
-
-        them_king = new_them[-1]
-
-        move_fns = [
-            self.pawn_moves,
-            self.knight_moves,
-            self.bishop_moves,
-            self.rook_moves,
-            self.queen_moves,
-            self.king_moves
-        ]
-
-        new_state.in_check = (move_fns[ix](target) & them_king) != 0
-        self.white = tmp_white
-        self.black = tmp_black
-        self.black_pos = tmp_black_pos
-        self.white_pos = tmp_white_pos
-
-        for _, attacked in new_state.list_moves():
-            if attacked & me_king:
-                raise IllegalMoveException(
-                    'You would be in check after this move')
+        if (piece, target) not in self.list_legal_moves():
+            raise IllegalMoveException(
+                'You would be in check after this move')
+        return self._make_child((piece, target), promotion_ix)
+
+    def _make_child(self, move: Tuple[int, int],
+                    promotion_ix: int = 4) -> 'State':
+        new_state = self.copy()
+        new_state.make_move(move, promotion_ix)
         return new_state
 
     def get_children(self) -> Iterable['State']:
@@ -851,42 +1652,32 @@ class State:
         Get a list of all possible child states
         """
         if self.moves_complete:
-            return self.children
-        else:
-            self.true_moves = []
-            self.children = []
-            move_list = self.list_moves()
-            for from_move, to_move in move_list:
-                for target in self.iter_pieces(to_move):
-                    try:
-                        state = self.get_child(from_move, target)
-                        self.true_moves.append((from_move, target))
-                        self.children.append(state)
-                        yield state
-                    except IllegalMoveException:
-                        pass
-            self.moves_complete = True
+            yield from self.children
+            return
+        children = []
+        for move in self.list_legal_moves():
+            state = self._make_child(move)
+            children.append(state)
+            yield state
+        self.children = children
+        self.moves_complete = True
 
     def get_random_child(self) -> 'State':
-        move_list = self.list_moves()
-        random.shuffle(move_list)
-        for from_move, to_move in move_list:
-            ipm = list(self.iter_pieces(to_move))
-            random.shuffle(ipm)
-            for target in ipm:
-                try:
-                    return self.get_child(from_move, target)
-                except IllegalMoveException:
-                    pass
+        moves = self.list_legal_moves()
+        if moves:
+            return self._make_child(random.choice(moves))
 
     def is_terminal(self) -> GameResult:
         if (self.black[5] == self.black_pos) and (
                     self.white[5] == self.white_pos):
             return GameResult.DRAW
-        for _ in self.get_children():
-            break
-
-        if len(self.children) > 0:
+        # Finding one legal move is enough, which the first stage of
+        # staged_moves usually does without listing quiet moves
+        if self.true_moves is not None:
+            has_moves = bool(self.true_moves)
+        else:
+            has_moves = next(self.staged_moves(), None) is not None
+        if has_moves:
             return GameResult.NONTERMINAL
         elif self.in_check:
             return GameResult.P1_WINS if not self.white_turn else \
@@ -900,12 +1691,12 @@ class State:
         ix_to_letter = ['p', 'n', 'b', 'r', 'q', 'k']
 
         for ix, pieces in enumerate(self.white):
-            for piece in self.iter_pieces(pieces):
-                white[64 - piece.bit_length()] = ix_to_letter[ix]
+            for piece in iter_bits(pieces):
+                white[BOARD_INDEX[piece]] = ix_to_letter[ix]
 
         for ix, pieces in enumerate(self.black):
-            for piece in self.iter_pieces(pieces):
-                black[64 - piece.bit_length()] = ix_to_letter[ix]
+            for piece in iter_bits(pieces):
+                black[BOARD_INDEX[piece]] = ix_to_letter[ix]
 
         winner = str(self.is_terminal()).split('.')[-1]
         in_check = self.in_check
@@ -952,13 +1743,49 @@ class State:
                      prev_move=prev_move,
                      can_castle=tuple(can_castle))
 
+    @staticmethod
+    def from_fen(fen: str) -> 'State':
+        """
+        Build a state from Forsyth-Edwards Notation. Castling rights are kept
+        per player, and the en passant square becomes the double pawn push
+        that allowed it
+        """
+        fields = fen.split()
+        if len(fields) < 2 or fields[1] not in ('w', 'b'):
+            raise IllegalStateException('Invalid FEN: %s' % fen)
+        pieces = []
+        for c in fields[0].replace('/', ''):
+            if c.isdigit():
+                pieces.extend([None] * int(c))
+            else:
+                pieces.append(c)
+        castling = fields[2] if len(fields) > 2 else '-'
+        en_passant = fields[3] if len(fields) > 3 else '-'
+        prev_move = None
+        if en_passant != '-':
+            square = 1 << (8 * (int(en_passant[1]) - 1) +
+                           ord('h') - ord(en_passant[0]))
+            if en_passant[1] == '3':
+                prev_move = (square >> 8, square << 8)
+            else:
+                prev_move = (square << 8, square >> 8)
+        state = State.from_dict(pieces, fields[1], False,
+                                ('K' in castling or 'Q' in castling,
+                                 'k' in castling or 'q' in castling),
+                                prev_move)
+        king = (state.white if state.white_turn else state.black)[5]
+        if king and state.is_attacked(king):
+            state.in_check = True
+            state.can_castle = False
+        return state
+
     def to_ndarray(self):
         out = np.zeros(64)
         for i in range(6):
-            for pt in self.iter_pieces(self.white[i]):
-                out[64 - pt.bit_length()] = i
-            for pt in self.iter_pieces(self.black[i]):
-                out[64 - pt.bit_length()] = -i
+            for pt in iter_bits(self.white[i]):
+                out[BOARD_INDEX[pt]] = i
+            for pt in iter_bits(self.black[i]):
+                out[BOARD_INDEX[pt]] = -i
         return out.reshape(8, 8)
 
     def __str__(self):
@@ -969,25 +1796,22 @@ class State:
         output = ['.'] * 64
         for white, player in zip([True, False], (self.white, self.black)):
             for name, locs in zip(names, player):
-                mask = 1 << 63
-                i = 0
-                while mask > 0:  # check every single square
-                    if locs & mask != 0:  # there's a piece at location
-                        # specified by mask
-                        output[i] = name.upper() if white else name.lower()
-                    mask >>= 1
-                    i += 1
+                for piece in iter_bits(locs):
+                    output[BOARD_INDEX[piece]] = \
+                        name.upper() if white else name.lower()
         return '\n'.join(''.join(output[8 * i:8 * (i + 1)]) for i in range(8))
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return (self.white, self.black, self.white_turn) == (
-                other.white, other.black, other.white_turn)
+            # The key also covers castling and en passant rights
+            return self.zobrist == other.zobrist and \
+                   (self.white, self.black, self.white_turn) == (
+                       other.white, other.black, other.white_turn)
         else:
             return False
 
     def __hash__(self):
-        return hash((self.white, self.black, self.white_turn))
+        return self.zobrist
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+"""
+Transposition table for the alpha-beta search: a fixed number of slots
+indexed by the position's Zobrist key, so positions reached by different move
+orders, or searched again on the next move, reuse earlier results.
+"""
+from typing import Optional, Tuple
+
+# Bound types: the stored score is exact, or the real score is at least /
+# at most the stored one because the search was cut off
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Replacement policies for a full slot
+ALWAYS = 'always'  # newest result wins
+DEPTH = 'depth'  # keep the deeper result, unless it is from an older search
+TWO_TIER = 'two_tier'  # a depth preferred and an always replace slot each
+POLICIES = (ALWAYS, DEPTH, TWO_TIER)
+
+# Rough size of a stored entry: the slot, the entry tuple, its key, score and
+# best move. Python objects make this an estimate rather than an exact count
+ENTRY_BYTES = 200
+
+# Entry layout
+KEY, DEPTH_IX, BOUND, SCORE, MOVE, AGE = range(6)
+
+Entry = Tuple[int, int, int, float, Optional[Tuple[int, int]], int]
+
+
+class TranspositionTable:
+    def __init__(self, size_mb: float = 16, policy: str = TWO_TIER) -> None:
+        """
+        Params:
+        ------
+        size_mb: float
+            Approximate memory cap for the table when full
+        policy: str
+            One of POLICIES, deciding which entry to keep when two positions
+            share a slot
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown replacement policy %r, expected one of '
+                             '%s' % (policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self.n_slots = max(int(size_mb * 2 ** 20 / ENTRY_BYTES), 2)
+        self.slots_per_bucket = 2 if policy == TWO_TIER else 1
+        self.n_buckets = self.n_slots // self.slots_per_bucket
+        self.age = 0
+        self.clear()
+
+    def clear(self) -> None:
+        self.table = [None] * (self.n_buckets * self.slots_per_bucket)
+        self.n_entries = 0
+        self.probes = 0
+        self.hits = 0
+
+    def new_search(self) -> None:
+        """
+        Mark entries stored so far as coming from an earlier search, so the
+        depth preferred policies let them be replaced
+        """
+        self.age += 1
+
+    def probe(self, key: int) -> Optional[Entry]:
+        """
+        Look a position up
+        Params:
+        ------
+        key: int
+            Zobrist key of the position
+        Returns:
+        ------
+        Optional[Entry]:
+            (key, depth, bound, score, best move, age) or None if the position
+            isn't stored
+        """
+        self.probes += 1
+        ix = (key % self.n_buckets) * self.slots_per_bucket
+        table = self.table
+        entry = table[ix]
+        if entry is not None and entry[KEY] == key:
+            self.hits += 1
+            return entry
+        if self.slots_per_bucket == 2:
+            entry = table[ix + 1]
+            if entry is not None and entry[KEY] == key:
+                self.hits += 1
+                return entry
+        return None
+
+    def store(self, key: int, depth: int, bound: int, score: float,
+              move: Optional[Tuple[int, int]]) -> None:
+        """
+        Save a search result, subject to the replacement policy
+        Params:
+        ------
+        key: int
+            Zobrist key of the position
+        depth: int
+            Remaining depth the position was searched to
+        bound: int
+            EXACT, LOWER or UPPER
+        score: float
+            Score found by the search
+        move: Tuple[int, int]
+            Best move found, or None
+        """
+        ix = (key % self.n_buckets) * self.slots_per_bucket
+        table = self.table
+        old = table[ix]
+        if old is not None and old[KEY] == key:
+            if move is None:
+                # Keep the best move from an earlier search of this position
+                move = old[MOVE]
+            table[ix] = (key, depth, bound, score, move, self.age)
+            return
+        new = (key, depth, bound, score, move, self.age)
+        if old is None or self.policy == ALWAYS or \
+                old[AGE] != self.age or old[DEPTH_IX] <= depth:
+            if old is None:
+                self.n_entries += 1
+            elif self.policy == TWO_TIER:
+                # The entry pushed out of the depth preferred slot takes the
+                # always replace slot
+                if table[ix + 1] is None:
+                    self.n_entries += 1
+                table[ix + 1] = old
+            table[ix] = new
+        elif self.policy == TWO_TIER:
+            if table[ix + 1] is None:
+                self.n_entries += 1
+            table[ix + 1] = new
+
+    def __len__(self) -> int:
+        return self.n_entries
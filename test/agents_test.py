@@ -1,12 +1,70 @@
+import multiprocessing
+import pickle
 import random
+import time
 import unittest
 
-from chess.agents import MinimaxAgent
-from chess.mcts import RandomMoveAgent, RandomPlayoutAgent
+from chess import agents, mcts
+from chess.agents import MinimaxAgent, CountingMinimaxAgent
+from chess.instrumentation import SearchStats
+from chess.mcts import RandomMoveAgent, RandomPlayoutAgent, MCTSAgent, PUCT
 from chess.value_network_agent import *
 from chess.state import State, IllegalMoveException
 
 
+class NullCountingAgent(agents.SampleMinimaxAgent):
+    null_moves = 0
+
+    def _alpha_beta(self, state, depth, alpha, beta, ply):
+        # Only a null move leaves no previous move below the root
+        if ply > 0 and state.prev_move is None:
+            self.null_moves += 1
+        return super()._alpha_beta(state, depth, alpha, beta, ply)
+
+
+class MaterialAgent(agents.SampleMinimaxAgent):
+    def heuristic(self, state):
+        score = sum(value * (bin(white).count('1') - bin(black).count('1'))
+                    for value, white, black in zip(
+                        self.capture_values, state.white, state.black))
+        return score if self.whose_turn else -score
+
+
+class ReversedPool:
+    """
+    Runs the jobs submitted to it in the parent process, last first, once
+    the first result is asked for, so later root moves finish earlier
+    """
+    def __init__(self):
+        self.jobs = []
+        # Every job submitted, in order
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        job = ReversedJob(self, fn, pickle.loads(pickle.dumps(args)))
+        self.jobs.append(job)
+        self.submitted.append(job)
+        return job
+
+    def shutdown(self):
+        pass
+
+
+class ReversedJob:
+    def __init__(self, pool, fn, args):
+        self.pool = pool
+        self.fn = fn
+        self.args = args
+        self.value = None
+
+    def result(self):
+        if self.pool.jobs:
+            for job in reversed(self.pool.jobs):
+                job.value = job.fn(*job.args)
+            self.pool.jobs = []
+        return self.value
+
+
 class SampleMinimaxAgent(MinimaxAgent):
     def __init__(self, max_depth: int = 3):
         super().__init__()
@@ -32,6 +90,274 @@ class MinimaxTest(unittest.TestCase):
         selected_move = agent.select_move(s)
         self.assertEqual(selected_move, (2 << 16, 2 << 8), 'Checkmate in 1')
 
+    def test_transposition_table(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        agent = CountingMinimaxAgent(3)
+        self.assertIsNotNone(agent.table, 'Table on by default')
+        no_table = CountingMinimaxAgent(3)
+        no_table.table = None
+        self.assertEqual(agent.select_move(s), no_table.select_move(s),
+                         'Same move with and without the table')
+        self.assertGreater(len(agent.table), 0, 'Positions stored')
+        first = agent.n_ab
+        agent.select_move(s)
+        self.assertLess(agent.n_ab, first, 'Second search reuses the first')
+        self.assertIsNone(agents.SampleMinimaxAgent(tt_mb=0).table,
+                          'Switched off')
+
+    def test_budget(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        agent = agents.SampleMinimaxAgent(max_depth=20, max_nodes=5000)
+        move = agent.select_move(s)
+        self.assertIn(move, s.list_legal_moves(), 'Legal move returned')
+        self.assertLessEqual(agent.nodes, 5000, 'Node budget kept')
+        self.assertLess(agent.completed_depth, 20, 'Stopped early')
+        self.assertGreater(agent.completed_depth, 1, 'Searched past depth 1')
+
+        agent = agents.SampleMinimaxAgent(max_depth=20, max_time='0.2')
+        start = time.time()
+        move = agent.select_move(s)
+        self.assertLess(time.time() - start, 1, 'Time budget kept')
+        self.assertIn(move, s.list_legal_moves(), 'Legal move in time')
+
+        agent = agents.SampleMinimaxAgent(max_depth=2)
+        agent.select_move(s)
+        self.assertEqual(agent.completed_depth, 2, 'No budget, full depth')
+
+    def test_move_ordering(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        nodes = []
+        moves = []
+        for flags in ('0', '1'):
+            agent = agents.SampleMinimaxAgent(
+                max_depth=3, tt_mb=0, use_mvv_lva=flags, use_killers=flags,
+                use_history=flags)
+            moves.append(agent.select_move(s))
+            nodes.append(agent.nodes)
+        self.assertEqual(moves[0], moves[1], 'Ordering keeps the best move')
+        self.assertLess(nodes[1], nodes[0], 'Ordering searches fewer nodes')
+        self.assertTrue(any(agent.killers), 'Killers recorded')
+        self.assertTrue(agent.history[0], 'History recorded for white')
+
+    def test_quiescence(self):
+        # Taking the pawn on h6 looks good at depth 1, until it is retaken
+        s = State.from_fen('4k3/6p1/7p/8/8/8/7Q/4K3 w - - 0 1')
+        grab = (1 << 8, 1 << 40)
+        agent = agents.SampleMinimaxAgent(max_depth=1, use_quiescence=False)
+        self.assertEqual(agent.select_move(s), grab, 'Horizon effect')
+        agent = agents.SampleMinimaxAgent(max_depth=1)
+        self.assertNotEqual(agent.select_move(s), grab, 'Sees the recapture')
+
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        nodes = []
+        for margin in (None, 2):
+            agent = agents.SampleMinimaxAgent(max_depth=2, tt_mb=0,
+                                              delta_margin=margin)
+            agent.select_move(s)
+            nodes.append(agent.nodes)
+        self.assertLess(nodes[1], nodes[0], 'Delta pruning skips captures')
+        agent = agents.SampleMinimaxAgent(delta_margin='None',
+                                          aspiration_window='')
+        self.assertIsNone(agent.delta_margin, 'Turned off with --kwarg')
+        self.assertIsNone(agent.aspiration_window, 'Turned off with --kwarg')
+        self.assertEqual(agents.SampleMinimaxAgent(delta_margin='1.5')
+                         .delta_margin, 150, 'In pawns')
+        agent = agents.SampleMinimaxAgent(max_depth=2, quiescence_ply=0)
+        self.assertIn(agent.select_move(s), s.list_legal_moves(),
+                      'Quiescence capped at the leaves')
+
+    def test_principal_variation_search(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        plain = agents.SampleMinimaxAgent(max_depth=3, use_pvs=False,
+                                          aspiration_window=None)
+        pvs = agents.SampleMinimaxAgent(max_depth=3)
+        plain.select_move(s)
+        pvs.select_move(s)
+        self.assertEqual(pvs.score, plain.score, 'Same score as alpha-beta')
+        self.assertEqual(len(pvs.principal_variation), 3, 'Full line')
+        self.assertEqual(pvs.principal_variation[0], pvs.optimal_move,
+                         'Line starts with the chosen move')
+        for move in pvs.principal_variation:
+            self.assertIn(move, s.list_legal_moves(), 'Line is legal')
+            s = s.get_child(*move)
+
+    def test_pruning(self):
+        s = State()
+        nodes = {}
+        for null_move in (False, True):
+            for lmr in (False, True):
+                agent = agents.SampleMinimaxAgent(max_depth=5,
+                                                  use_null_move=null_move,
+                                                  use_lmr=lmr)
+                self.assertIn(agent.select_move(s), s.list_legal_moves(),
+                              'Legal move')
+                nodes[null_move, lmr] = agent.nodes
+        self.assertLess(nodes[True, False], nodes[False, False],
+                        'Null move pruning')
+        self.assertLess(nodes[False, True], nodes[False, False],
+                        'Late move reductions')
+        self.assertLess(nodes[True, True], nodes[True, False], 'Both')
+
+        # Passing could be better than any move with only kings and pawns
+        agent = NullCountingAgent(max_depth=5, use_lmr='0',
+                                  null_move_depth='1')
+        agent.select_move(s)
+        self.assertGreater(agent.null_moves, 0, 'Null moves tried')
+        agent = NullCountingAgent(max_depth=5, use_lmr='0',
+                                  null_move_depth='1')
+        agent.select_move(State.from_fen('8/8/p7/P7/8/1k6/8/K7 w - - 0 1'))
+        self.assertEqual(agent.null_moves, 0, 'No null move in pawn endgames')
+
+    def test_ponder(self):
+        s = State()
+        agent = agents.SampleMinimaxAgent(max_depth=4)
+        reports = []
+        agent.stats = SearchStats(reports.append)
+        self.assertFalse(agent.ponder(s), 'Nothing searched yet')
+        move = agent.select_move(s)
+        line = list(agent.principal_variation)
+        s = s.get_child(*move)
+        self.assertTrue(agent.ponder(s), 'Pondering')
+        expected = s.get_child(*line[1])
+        reply = agent.stop_pondering(expected)
+        self.assertIn(reply, expected.list_legal_moves(), 'Ponder hit')
+        self.assertEqual(agent.completed_depth, 4, 'Search finished')
+        self.assertFalse(reports[-1]['ponder'], 'Reported as a normal search')
+
+        line = list(agent.principal_variation)
+        s = expected.get_child(*reply)
+        self.assertTrue(agent.ponder(s), 'Pondering again')
+        other = [m for m in s.list_legal_moves() if m != line[1]][0]
+        self.assertIsNone(agent.stop_pondering(s.get_child(*other)),
+                          'Ponder miss')
+        self.assertIsNone(agent._ponder_thread, 'Thread stopped')
+        self.assertTrue(reports[-1]['ponder'], 'Reported as pondering')
+        agent.select_move(s.get_child(*other))
+        self.assertEqual(agent.completed_depth, 4, 'Next search not stopped')
+
+        agent = agents.SampleMinimaxAgent(max_depth=20, max_time=0.2,
+                                          max_ponder_time=0.2)
+        s = State()
+        s = s.get_child(*agent.select_move(s))
+        expected = s.get_child(*agent.principal_variation[1])
+        self.assertTrue(agent.ponder(s), 'Pondering')
+        agent._ponder_thread.join(10)
+        self.assertFalse(agent._ponder_thread.is_alive(), 'Ponder time capped')
+        self.assertIn(agent.stop_pondering(expected),
+                      expected.list_legal_moves(), 'Move kept for a hit')
+
+    def test_stats(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        reports = []
+        agent = agents.SampleMinimaxAgent(max_depth=3)
+        agent.stats = SearchStats(reports.append)
+        move = agent.select_move(s)
+        report, = reports
+        self.assertEqual(report['move'], [move[0].bit_length() - 1,
+                                          move[1].bit_length() - 1], 'Move')
+        self.assertEqual(report['nodes'], agent.nodes, 'Nodes')
+        self.assertEqual(sum(report['nodes_per_ply']), agent.nodes,
+                         'Every node counted by ply')
+        self.assertEqual(report['depth'], 3, 'Depth')
+        self.assertGreater(report['max_ply'], 3, 'Quiescence plies')
+        self.assertGreater(report['first_move_cutoff_rate'], 0.5,
+                           'Good move ordering')
+        self.assertIsNotNone(report['branching_factor'], 'Branching factor')
+        self.assertIsNotNone(report['tt_hit_rate'], 'Table hit rate')
+        self.assertEqual(report['score'], agent.score, 'Score')
+        self.assertIsNone(pickle.loads(pickle.dumps(agent)).stats,
+                          'Not sent to workers')
+
+        agent = RandomPlayoutAgent(max_time=0.05)
+        agent.stats = SearchStats()
+        agent.select_move(State())
+        self.assertGreater(agent.stats.report['nodes'], 0, 'Playout moves')
+        agent = RandomPlayoutAgent(max_time=0.05, max_depth=2)
+        agent.stats = SearchStats()
+        agent.select_move(State())
+        self.assertEqual(agent.stats.report['nodes_per_ply'],
+                         [0, 0, agent.playouts], 'One move per playout')
+
+    def test_mate_score(self):
+        s = State(
+            (0, 0, 0, 0, 2 << 16, 4 << 16),
+            (0, 0, 0, 0, 0, 1),
+            turn='w',
+            in_check=False
+        )
+        agent = agents.SampleMinimaxAgent(max_depth=3)
+        agent.select_move(s)
+        self.assertEqual(agent.score, agents.MATE_SCORE - 1, 'Mate in one')
+        self.assertEqual(agent.principal_variation, [(2 << 16, 2 << 8)],
+                         'Line ends at mate')
+
+    def test_parallel(self):
+        s = State.from_fen('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                           'R3K2R w KQkq - 0 1')
+        serial = agents.SampleMinimaxAgent(max_depth=3)
+        serial.select_move(s)
+        parallel = agents.SampleMinimaxAgent(max_depth=3, workers=2)
+        try:
+            move = parallel.select_move(s)
+            self.assertEqual(parallel.score, serial.score,
+                             'Same score as the serial search')
+            self.assertIn(move, s.list_legal_moves(), 'Legal move')
+            self.assertEqual(parallel.principal_variation[0], move,
+                             'Line starts with the move')
+            pool = parallel._pool
+            self.assertIsNotNone(pool, 'Pool started')
+            parallel.select_move(s)
+            self.assertIs(parallel._pool, pool, 'Pool kept between searches')
+            self.assertIsNone(pickle.loads(pickle.dumps(parallel))._pool,
+                              'Pool not copied')
+            parallel._max_depth = 6
+            parallel.max_nodes = 100000
+            parallel.select_move(s)
+            # Each worker checks the budget every 256 nodes
+            self.assertLessEqual(parallel.nodes, 100000 + 2 * 256,
+                                 'Node budget shared between jobs')
+        finally:
+            parallel.close()
+        self.assertIsNone(parallel._pool, 'Pool closed')
+
+    def test_parallel_fail_low(self):
+        # Workers finish in reverse order, so moves searched later raise the
+        # shared bound that moves submitted earlier fail low against. Taking
+        # either rook wins the same, so a move failing low returns a bound
+        # equal to the best score
+        s = State.from_fen('6k1/8/8/7r/r7/8/8/1K1Q4 w - - 0 1')
+        agent = MaterialAgent(workers=2)
+        pool = agent._pool = ReversedPool()
+        agent._shared_alpha = multiprocessing.Value('d', 0.0)
+        agent._shared_nodes = multiprocessing.Value('q', 0)
+        agents._init_worker(pickle.loads(pickle.dumps(agent)),
+                            agent._shared_alpha, agent._shared_nodes)
+        agent._start_search(s.white_turn)
+        agent._search_id += 1
+        agent._deadline = None
+        agent._next_check = float('inf')
+        agent._pv = [[] for _ in range(3)]
+        # A king move searched first, by the parent
+        agent.optimal_move = (1 << 6, 1 << 14)
+        score = agent._parallel_root(s, 2)
+        self.assertEqual(score, 700, 'Rook won')
+        results = [job.value for job in pool.submitted]
+        chosen = [result for result in results
+                  if result[0] == agent.optimal_move][0]
+        self.assertTrue(chosen[2], 'Exact score')
+        failed_low = [result for result in results[:results.index(chosen)]
+                      if result[1] == score]
+        self.assertTrue(failed_low, 'Bound equal to the score came first')
+        self.assertFalse(any(result[2] for result in failed_low),
+                         'Only bounds')
+        self.assertEqual(agent._pv[0][0], agent.optimal_move, 'Its line')
+
 
 class RandomAgentTest(unittest.TestCase):
     def test_select_move_random(self):
@@ -55,6 +381,118 @@ class RandomAgentTest(unittest.TestCase):
         selected_move = agent.select_move(s)
         self.assertEqual(selected_move, (2 << 16, 2 << 8), 'Checkmate in 1')
 
+    def test_parallel_playouts(self):
+        agent = RandomPlayoutAgent(max_time=0.5, max_depth=2, workers=2,
+                                   seed=5)
+        s = State(
+            (0, 0, 0, 0, 2 << 16, 4 << 16),
+            (0, 0, 0, 0, 0, 1),
+            turn='w',
+            in_check=False
+        )
+        try:
+            self.assertEqual(agent.select_move(s), (2 << 16, 2 << 8),
+                             'Checkmate in 1')
+            self.assertGreater(agent.playouts, 1, 'Playouts counted')
+            pool = agent._pool
+            agent.stats = SearchStats()
+            agent.select_move(s)
+            self.assertIs(agent._pool, pool, 'Pool kept between searches')
+            report = agent.stats.report
+            self.assertGreater(report['nodes'], 0, 'Workers\' nodes counted')
+            self.assertEqual(report['nodes'], sum(report['nodes_per_ply']),
+                             'Nodes counted by ply')
+            self.assertLessEqual(report['nodes_per_ply'][-1], agent.playouts,
+                                 'One move per playout')
+        finally:
+            agent.close()
+        self.assertIsNone(agent._pool, 'Pool closed')
+
+        index = multiprocessing.Value('i', 0)
+        streams = []
+        for _ in range(2):
+            agents._init_worker(pickle.loads(pickle.dumps(agent)), index)
+            streams.append(agents.worker_agent()._rng.random())
+        self.assertNotEqual(streams[0], streams[1], 'Own stream per worker')
+        agents._init_worker(pickle.loads(pickle.dumps(agent)),
+                            multiprocessing.Value('i', 0))
+        self.assertEqual(agents.worker_agent()._rng.random(), streams[0],
+                         'Seeded')
+
+
+class MCTSAgentTest(unittest.TestCase):
+    def test_mate(self):
+        s = State.from_fen('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/'
+                           'RNB1K1NR w KQkq - 4 4')
+        mate = (1 << 32, 1 << 50)
+        random.seed(124915)
+        for policy in ('uct', PUCT):
+            agent = MCTSAgent(max_time=None, max_playouts=300, policy=policy)
+            self.assertEqual(agent.select_move(s), mate, 'Scholar\'s mate')
+            self.assertEqual(agent.playouts, 300, 'Playout budget')
+        with self.assertRaises(ValueError):
+            MCTSAgent(policy='ucb')
+        agent = MCTSAgent(max_time='None', max_playouts='20')
+        self.assertEqual((agent.max_time, agent.max_playouts), (None, 20),
+                         'Playout budget only, from --kwarg')
+        with self.assertRaises(ValueError):
+            MCTSAgent(max_time='None')
+
+        reports = []
+        agent = MCTSAgent(max_time=None, max_playouts=10)
+        agent.stats = SearchStats(reports.append)
+        self.assertIsNone(agent.select_move(
+            State.from_fen('R5k1/5ppp/8/8/8/8/8/6K1 b - - 0 1')), 'Mated')
+        self.assertEqual(len(reports), 1, 'Reported anyway')
+        self.assertIsNone(reports[0]['move'], 'No move')
+
+    def test_priors(self):
+        s = State.from_fen('4k3/8/8/3q4/8/8/3Q4/4K3 w - - 0 1')
+        moves = s.list_legal_moves()
+        priors = MCTSAgent(policy=PUCT).priors(s, moves)
+        self.assertAlmostEqual(sum(priors), 1, 8, 'Normalized')
+        capture = moves.index((1 << 12, 1 << 36))
+        self.assertEqual(max(priors), priors[capture], 'Queen capture first')
+
+    def test_tree_reuse(self):
+        s = State()
+        random.seed(124915)
+        agent = MCTSAgent(max_time=None, max_playouts=400, max_depth=10)
+        move = agent.select_move(s)
+        self.assertEqual(agent.reused_visits, 0, 'New tree')
+        s = s.get_child(*move)
+        reply = max(agent.root.children, key=lambda child: child.visits)
+        s = s.get_child(*reply.move)
+        visits = reply.visits
+        agent.select_move(s)
+        self.assertEqual(agent.reused_visits, visits, 'Subtree kept')
+        self.assertEqual(agent.root.parent, None, 'Old tree dropped')
+
+        agent.select_move(State(turn='b'))
+        self.assertEqual(agent.reused_visits, 0, 'Unknown position')
+        agent = MCTSAgent(max_time=None, max_playouts=50, reuse_tree='0')
+        agent.select_move(State())
+        agent.select_move(State().get_child(*agent.root.move)
+                          .get_child(*agent.root.children[0].move))
+        self.assertEqual(agent.reused_visits, 0, 'Reuse turned off')
+
+    def test_batches(self):
+        for virtual_loss, most_visits in ((0, 20), (2, 1)):
+            agent = MCTSAgent(max_time=None, max_playouts=20,
+                              virtual_loss=virtual_loss)
+            root = mcts.Node(white=False)
+            agent._iterate(root, State(), 20)
+            self.assertEqual(root.visits, 20, 'Whole batch backed up')
+            self.assertEqual(sum(child.visits for child in root.children), 20,
+                             'Virtual losses taken back')
+            self.assertEqual(max(child.visits for child in root.children),
+                             most_visits, 'Virtual losses spread a batch')
+        agent = MCTSAgent(max_time=None, max_playouts=50, batch_size=16)
+        agent.select_move(State())
+        self.assertEqual(agent.playouts, 50, 'Last batch cut short')
+        with self.assertRaises(ValueError):
+            MCTSAgent(batch_size=0)
+
 
 class LearningAgentTest(unittest.TestCase):
     def test_relu(self):
@@ -107,6 +545,30 @@ class LearningAgentTest(unittest.TestCase):
             is_legal = False
         self.assertTrue(is_legal, 'White select move')
 
+    def test_values(self):
+        np.random.seed(185192)
+        a = ValueNetworkAgent()
+        children = list(State().get_children())
+        values = a.values(children, True)
+        for child, value in zip(children, values):
+            self.assertAlmostEqual(a.values([child], True)[0], value, 5,
+                                   'Batch matches one at a time')
+        self.assertEqual(a.select_move(State()),
+                         children[values.argmax()].prev_move, 'Best child')
+
+    def test_mcts(self):
+        np.random.seed(185192)
+        agent = ValueNetworkMCTSAgent(max_time=None, max_playouts=64,
+                                      batch_size=16)
+        s = State()
+        move = agent.select_move(s)
+        self.assertIn(move, s.list_legal_moves(), 'Legal move')
+        self.assertEqual(agent.playouts, 64, 'Leaf budget')
+        children = list(s.get_children())
+        self.assertEqual(agent.evaluate(children),
+                         agent.network.values(children, True).tolist(),
+                         'Leaves scored for white')
+
     def test_framework(self):  # can't really test this, but we're just
         # making sure eveerything runs without errors, because we have
         # already tested the update function
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from chess.batch import BatchState
+from chess.perft import POSITIONS
+from chess.state import State, KNIGHT_MOVES
+
+
+class BatchStateTest(unittest.TestCase):
+    def setUp(self):
+        self.states = [State.from_fen(fen) for fen, _ in POSITIONS.values()]
+        # Black to move and in check from the queen on h5
+        self.states.append(State.from_fen(
+            'rnbqkbnr/ppppp2p/5p2/6pQ/4P3/8/PPPP1PPP/RNB1KBNR b KQkq - 1 3'))
+        self.batch = BatchState.from_states(self.states)
+
+    def test_occupancy(self):
+        self.assertEqual(len(self.batch), len(self.states), 'One per state')
+        self.assertEqual([int(x) for x in self.batch.white_pos],
+                         [s.white_pos for s in self.states], 'White pieces')
+        self.assertEqual([int(x) for x in self.batch.occupancy],
+                         [s.white_pos | s.black_pos for s in self.states],
+                         'All pieces')
+
+    def test_attacks(self):
+        for white in (True, False):
+            self.assertEqual([int(x) for x in self.batch.attack_map(white)],
+                             [s.attack_map(white) for s in self.states],
+                             'Attack maps match State')
+        attacks = self.batch.attacks(True)
+        self.assertEqual(attacks.shape, (len(self.states), 6), 'Per piece')
+        self.assertEqual(int(attacks[0, 1]),
+                         KNIGHT_MOVES[0x40] | KNIGHT_MOVES[0x2],
+                         'Knights at the start')
+
+    def test_in_check(self):
+        self.assertEqual(list(self.batch.in_check()),
+                         [s.in_check for s in self.states], 'Check flags')
+        self.assertTrue(self.batch.in_check()[-1], 'Black in check')
+
+    def test_to_ndarray(self):
+        expected = np.array([s.to_ndarray() for s in self.states])
+        np.testing.assert_array_equal(self.batch.to_ndarray(), expected)
+        black = State(turn='b')
+        np.testing.assert_array_equal(
+            BatchState.from_states([black]).features()[0],
+            -black.to_ndarray()[::-1].reshape(64), 'Black to move is flipped')
+
+    def test_bad_shape(self):
+        with self.assertRaises(ValueError):
+            BatchState(np.zeros((3, 6), dtype=np.uint64), np.ones(3))
@@ -0,0 +1,112 @@
+import os
+import random
+import tempfile
+import unittest
+
+from chess.agents import Agent
+from chess.book import *
+from chess.instrumentation import SearchStats
+from chess.state import State, IllegalMoveException
+
+GAMES = [
+    '1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0',
+    '1. e4 e5 2. Nf3 Nc6 3. Bc4 1/2-1/2',
+    'd2d4 d7d5 c2c4',
+]
+
+
+class FixedAgent(Agent):
+    def __init__(self):
+        self.calls = 0
+
+    def select_move(self, state):
+        self.calls += 1
+        return state.list_legal_moves()[0]
+
+
+class BookTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'book.bin')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_parse_move(self):
+        s = State()
+        e4 = (square('e2'), square('e4'))
+        self.assertEqual(e4, (1 << 11, 1 << 27), 'Square names')
+        self.assertEqual(parse_move(s, 'e4'), (e4, 4), 'Pawn push')
+        self.assertEqual(parse_move(s, 'e2e4'), (e4, 4), 'Coordinates')
+        self.assertEqual(parse_move(s, 'Nf3')[0], (1 << 1, 1 << 18), 'Knight')
+        s = State.from_fen('r3k2r/1P6/8/8/8/8/8/R3K2R w KQkq - 0 1')
+        self.assertEqual(parse_move(s, 'O-O-O')[0], (0x8, 0x20), 'Castles')
+        self.assertEqual(parse_move(s, 'bxa8=N+')[1], 1, 'Underpromotion')
+        self.assertEqual(parse_move(s, 'b7b8r')[1], 3, 'Coordinates too')
+        self.assertEqual(parse_move(s, 'Rad1')[0], (1 << 7, 1 << 4),
+                         'Disambiguated')
+        for move in ('Qd1', 'e4', 'Zz9'):
+            with self.assertRaises(IllegalMoveException):
+                parse_move(s, move)
+        s = State.from_fen('4k3/8/8/8/8/8/4K3/R6R w - - 0 1')
+        with self.assertRaises(IllegalMoveException):
+            parse_move(s, 'Rd1')
+
+    def test_game_moves(self):
+        self.assertEqual(
+            game_moves('1. e4 {Best by test} e5 2. Nf3 {a comment, 3. d4}'
+                       ' Nc6 ; the rest of the line 3. Bb5'),
+            ['e4', 'e5', 'Nf3', 'Nc6'], 'Comments skipped')
+        self.assertEqual(game_moves('1.e4 e5 2.Nf3 1-0'), ['e4', 'e5', 'Nf3'],
+                         'Move numbers and result skipped')
+
+    def test_book(self):
+        self.assertEqual(build_book(GAMES, self.path, max_plies=4), 7,
+                         'One entry per position and move')
+        with OpeningBook(self.path) as book:
+            self.assertEqual(len(book), 7, 'Entries')
+            s = State()
+            self.assertEqual(book.moves(s), [
+                ((1 << 11, 1 << 27), 4, 2), ((1 << 12, 1 << 28), 4, 1)],
+                'Most played first')
+            rng = random.Random(3)
+            moves = {book.choose(s, rng) for _ in range(50)}
+            self.assertEqual(moves, {(1 << 11, 1 << 27), (1 << 12, 1 << 28)},
+                             'Both moves played')
+            s = s.get_child(1 << 11, 1 << 27).get_child(1 << 51, 1 << 35)
+            self.assertEqual(book.choose(s), (1 << 1, 1 << 18), 'Nf3')
+            s = s.get_child(1 << 1, 1 << 18)
+            s = s.get_child(1 << 62, 1 << 45)
+            self.assertEqual(book.moves(s), [], 'Out of the book')
+            self.assertIsNone(book.choose(s), 'No move')
+        self.assertEqual(build_book(GAMES, self.path, min_count=2), 4,
+                         'Moves played once left out')
+
+    def test_agent(self):
+        build_book(GAMES, self.path)
+        with OpeningBook(self.path) as book:
+            searcher = FixedAgent()
+            agent = BookAgent(searcher, book)
+            agent.select_move(State())
+            self.assertEqual(searcher.calls, 0, 'Book move')
+            agent.select_move(State(turn='b'))
+            self.assertEqual(searcher.calls, 1, 'Searched')
+
+            reports = []
+            agent.stats = SearchStats(reports.append)
+            self.assertIs(searcher.stats, agent.stats, 'Shared stats')
+            move = agent.select_move(State())
+            self.assertEqual(len(reports), 1, 'Book move reported')
+            self.assertEqual(reports[0]['nodes'], 0, 'Nothing searched')
+            self.assertTrue(reports[0]['book'], 'From the book')
+            self.assertEqual(reports[0]['move'], [move[0].bit_length() - 1,
+                                                  move[1].bit_length() - 1],
+                             'Move')
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a book at all')
+        with self.assertRaises(ValueError):
+            OpeningBook(self.path)
+        with self.assertRaises(IllegalMoveException):
+            build_book(['1. e4 e4'], self.path)
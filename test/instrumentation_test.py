@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import unittest
+
+from chess.instrumentation import SearchStats, json_lines
+from chess.transposition import TranspositionTable
+
+
+class SearchStatsTest(unittest.TestCase):
+    def test_counters(self):
+        stats = SearchStats()
+        stats.node(0)
+        stats.node(2, 3)
+        stats.cutoff(True)
+        stats.cutoff(False)
+        stats.iteration(1, 10)
+        stats.iteration(2, 50)
+        self.assertEqual(stats.nodes_per_ply, [1, 0, 3], 'Nodes by ply')
+        self.assertEqual(stats.branching_factor(), 4, '40 nodes after 10')
+        self.assertEqual(list(stats.moves(iter([(1, 2), (4, 8)]))),
+                         [(1, 2), (4, 8)], 'Moves passed through')
+        self.assertEqual(stats.evaluate(len, 'abc'), 3, 'Heuristic called')
+
+        report = stats.finish(object(), (1, 1 << 8), score=2)
+        self.assertEqual(report['move'], [0, 8], 'Move as squares')
+        self.assertEqual(report['nodes'], 4, 'Nodes summed')
+        self.assertEqual(report['max_ply'], 2, 'Deepest ply')
+        self.assertEqual(report['depth'], 2, 'Last iteration')
+        self.assertEqual(report['first_move_cutoff_rate'], 0.5,
+                         'First move cutoffs')
+        self.assertEqual(report['score'], 2, 'Extra fields')
+        self.assertNotIn('tt_hit_rate', report, 'No table')
+        self.assertEqual(json.loads(stats.to_json()), report, 'JSON')
+
+        stats.start()
+        self.assertEqual(stats.nodes_per_ply, [], 'Reset')
+        self.assertIsNone(stats.branching_factor(), 'No iterations')
+
+    def test_table(self):
+        table = TranspositionTable(1)
+        table.store(1, 1, 0, 0, None)
+        table.probe(2)
+        stats = SearchStats()
+        stats.start(table)
+        table.probe(1)
+        table.probe(3)
+        report = stats.finish(object(), None)
+        self.assertEqual(report['tt_probes'], 2, 'Probes in this search')
+        self.assertEqual(report['tt_hit_rate'], 0.5, 'Hit rate')
+
+    def test_hooks(self):
+        reports = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stats.jsonl')
+            stats = SearchStats(reports.append, json_lines(path))
+            stats.finish(object(), None)
+            stats.finish(object(), None)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(len(reports), 2, 'Hook called per search')
+        self.assertEqual(lines, reports, 'One line per search')
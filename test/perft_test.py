@@ -0,0 +1,38 @@
+import unittest
+
+from chess.perft import POSITIONS, perft, divide
+from chess.state import State
+
+
+class PerftTest(unittest.TestCase):
+    def test_standard_positions(self):
+        for name, (fen, counts) in POSITIONS.items():
+            for depth, expected in enumerate(counts[:2], 1):
+                actual = perft(State.from_fen(fen), depth)
+                self.assertEqual(actual, expected,
+                                 '%s perft %d' % (name, depth))
+
+    def test_start_depth_3(self):
+        self.assertEqual(perft(State(), 3), 8902, 'Start position perft 3')
+
+    def test_divide(self):
+        state = State.from_fen(POSITIONS['promotions'][0])
+        actual = divide(state, 2)
+        self.assertEqual(len(actual), 6, 'One entry per root move')
+        self.assertEqual(sum(count for _, count in actual), 264,
+                         'Divide adds up to perft')
+
+        actual = dict(divide(State.from_fen('4k3/1P6/8/8/8/8/8/4K3 w - - 0 1'),
+                             1))
+        for name in ('b7b8q', 'b7b8r', 'b7b8b', 'b7b8n'):
+            self.assertEqual(actual[name], 1, 'Promotions named by piece')
+
+    def test_restores_state(self):
+        state = State.from_fen(POSITIONS['kiwipete'][0])
+        before = state.copy()
+        perft(state, 2)
+        self.assertEqual(state, before, 'Perft leaves the state unchanged')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import random
+import unittest
+
+from chess.perft import POSITIONS
+from chess.playout import pseudo_legal_targets, random_playout
+from chess.state import State, GameResult, iter_bits
+
+
+def pseudo_legal_moves(state):
+    me, them = (state.white, state.black) if state.white_turn else \
+        (state.black, state.white)
+    sources, pieces, targets, counts = [0] * 16, [0] * 16, [0] * 16, [0] * 16
+    n = pseudo_legal_targets(me, them, state.white_turn,
+                             state._en_passant_target(), sources, pieces,
+                             targets, counts)
+    return {(sources[i], target) for i in range(n)
+            for target in iter_bits(targets[i])}
+
+
+class PlayoutTest(unittest.TestCase):
+    def test_pseudo_legal_moves(self):
+        fens = [fen for fen, _ in POSITIONS.values()]
+        fens.append('4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1')
+        for fen in fens:
+            s = State.from_fen(fen)
+            moves = pseudo_legal_moves(s)
+            king = s.white[5] if s.white_turn else s.black[5]
+            legal = {move for move in s.list_legal_moves()
+                     if move not in ((king, king << 2), (king, king >> 2))}
+            self.assertLessEqual(legal, moves, 'Every legal move but castling')
+            for move in moves - legal:
+                child = s.copy()
+                child.make_move(move)
+                square = move[1] if move[0] == king else king
+                self.assertTrue(child.is_attacked(square, not s.white_turn),
+                                'Only illegal moves leave the king in check')
+
+    def test_results(self):
+        # White to move can take the king
+        s = State((0, 0, 0, 0, 1 << 16, 1), (0, 0, 0, 0, 0, 1 << 18))
+        self.assertEqual(random_playout(s, 10), (GameResult.P1_WINS, 0),
+                         'King taken')
+        mated = State.from_fen('R5k1/5ppp/8/8/8/8/8/6K1 b - - 0 1')
+        self.assertEqual(random_playout(mated, 10), (GameResult.P1_WINS, 0),
+                         'Checkmate scored exactly')
+        kings = State.from_fen('8/8/3k4/8/8/3K4/8/8 w - - 0 1')
+        self.assertEqual(random_playout(kings, 10)[0], GameResult.DRAW,
+                         'Only kings')
+        self.assertEqual(random_playout(State(), 0),
+                         (GameResult.NONTERMINAL, 0), 'Stopped')
+
+    def test_playout(self):
+        s = State.from_fen(POSITIONS['kiwipete'][0])
+        before = s.copy()
+        first = random_playout(s, 200, random.Random(3))
+        self.assertEqual(s, before, 'Position not changed')
+        self.assertEqual(random_playout(s, 200, random.Random(3)), first,
+                         'Seeded')
+        self.assertLessEqual(first[1], 200, 'Within max plies')
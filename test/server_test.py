@@ -1,6 +1,8 @@
 import json
+import threading
 import unittest
 
+from chess import server
 from chess.state import State
 from chess.server import app
 
@@ -297,6 +299,53 @@ class ServerTestOnePlayer(unittest.TestCase):
         self.assertEqual(200, result.status_code, 'Status is OK')
         self.assertEqual(data['winner'], 'P2_WINS', 'White moves, AI wins')
 
+    def test_ponder(self):
+        s = State()
+        request = s.to_dict()
+        request.pop('winner', None)
+        request['piece'] = 11
+        request['target'] = 27
+        server.ponder = True
+        try:
+            result = self.app.post(
+                '/moveai', data=json.dumps(request),
+                headers={'content-type': 'application/json'})
+            self.assertEqual(200, result.status_code, 'Status is OK')
+            self.assertIsNotNone(server.agent._ponder_thread,
+                                 'Searching on the user\'s time')
+            self.app.get('/reset')
+            self.assertIsNotNone(server.agent._ponder_thread,
+                                 'Only the next AI move stops it')
+            request = State().to_dict()
+            request.pop('winner', None)
+            request['piece'] = 1
+            request['target'] = 18
+            self.app.post('/moveai', data=json.dumps(request),
+                          headers={'content-type': 'application/json'})
+            self.assertIsNotNone(server.agent._ponder_thread,
+                                 'Searching the new game')
+        finally:
+            server.ponder = False
+            server.stop_pondering()
+
+    def test_agent_lock(self):
+        request = State().to_dict()
+        request.pop('winner', None)
+        request['piece'] = 1
+        request['target'] = 18
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.app.post('/moveai', data=json.dumps(request),
+                          headers={'content-type': 'application/json'})))
+        with server.agent_lock:
+            thread.start()
+            thread.join(0.2)
+            self.assertEqual(results, [], 'Waits for the agent')
+            self.assertEqual(self.app.get('/reset').status_code, 200,
+                             'Reset doesn\'t')
+        thread.join()
+        self.assertEqual(results[0].status_code, 200, 'Then runs')
+
 
 if __name__ == '__main__':
     unittest.main()
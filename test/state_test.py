@@ -27,6 +27,13 @@ class StateTest(unittest.TestCase):
                    '........\n11111111\n........\n........'
         self.assertEqual(s, expected, 'Board to string')
 
+    def test_iter_bits(self):
+        self.assertEqual(list(iter_bits(0x8000000000000101)),
+                         [0x1, 0x100, 0x8000000000000000], 'Set bits')
+        self.assertEqual(list(iter_bits(0)), [], 'Empty board')
+        self.assertEqual(BOARD_INDEX[1 << 63], 0, 'a8 is the first square')
+        self.assertEqual(BOARD_INDEX[1], 63, 'h1 is the last square')
+
     def test_unmoved_pawn_no_blocking(self):
         state = State()
         actual = state.get_moves(0x1000)
@@ -122,6 +129,18 @@ class StateTest(unittest.TestCase):
         expected = 0
         self.assertEqual(actual, expected, "Bishop with no moves")
 
+    def test_slider_tables(self):
+        blockers = (1 << 34) | (1 << 16)
+        actual = rook_attacks(1 << 18, blockers)
+        expected = (1 << 26) | (1 << 34) | (1 << 10) | (1 << 2) | (1 << 17) | \
+                   (1 << 16) | (0xf8 << 16)
+        self.assertEqual(actual, expected, 'Rook attacks with blockers')
+
+        actual = bishop_attacks(1 << 18, 1 << 36)
+        expected = (1 << 27) | (1 << 36) | (1 << 25) | (1 << 32) | \
+                   (1 << 11) | (1 << 4) | (1 << 9) | (1 << 0)
+        self.assertEqual(actual, expected, 'Bishop attacks with blockers')
+
     def test_queen(self):
         state = State(wq=0x8000000)
         actual = state.queen_moves(0x8000000)
@@ -181,6 +200,34 @@ class StateTest(unittest.TestCase):
         self.assertRaises(IllegalMoveException, s.get_child, 0x8, 0x2)
         self.assertRaises(IllegalMoveException, s.get_child, 0x8, 0x20)
 
+    def test_attacks(self):
+        s = State()
+        self.assertEqual(s.attackers_to(0x40000, True), 0x2 | 0x200 | 0x800,
+                         'Knight and pawns defending f3')
+        self.assertEqual(s.attackers_to(0x40000, False), 0,
+                         'Nothing attacking f3')
+        self.assertTrue(s.is_attacked(0x4 << 40), 'Black defends f6')
+        self.assertFalse(s.is_attacked(0x8 << 32), 'Nobody attacks e5')
+
+        s = State((0, 0, 0, 0x80, 0, 0x8), (0, 0, 0x2 << 8, 0, 0, 1 << 63))
+        self.assertEqual(s.attackers_to(0x4, False), 0x200,
+                         'Bishop attacking f1')
+        self.assertEqual(s.attackers_to(0x4, False, 0x200 | 0x4), 0x200,
+                         'Attackers with given occupancy')
+        attacks = s.attack_map(True)
+        self.assertEqual(attacks, rook_attacks(0x80, s.white_pos) |
+                         KING_MOVES[0x8], 'White attack map')
+        self.assertIs(s.attack_map(True), attacks, 'Attack map cached')
+        self.assertTrue(s.is_attacked(0x40, True), 'Attacked, from the map')
+        s.make_move((0x80, 0x40))
+        self.assertNotEqual(s.attack_map(True), attacks,
+                            'Attack map recomputed after a move')
+
+        s = State.from_fen('4k3/8/8/8/8/8/8/3QK3 w - - 0 1')
+        s.attack_map(True)
+        s.make_move((1 << 4, 1 << 11))
+        self.assertTrue(s.in_check, 'Check seen with a stale attack map')
+
     def test_list(self):
         state = State((0xff00, 0, 0, 0, 0, 0), (0, 0, 0, 0, 0, 0), 'w')
         actual = sorted(state.list_moves())
@@ -197,6 +244,89 @@ class StateTest(unittest.TestCase):
             (0x80000, 0x80000 >> i) for i in [7, 8, 9]])
         self.assertEqual(actual, expected, 'List Moves')
 
+    def test_list_legal_check(self):
+        # Black rook gives check on the e-file, white can only capture it
+        # with the knight or step off the file
+        s = State((0, 0x40000, 0, 0, 0, 0x8), (0, 0, 0, 0x8 << 32, 0, 1 << 63))
+        actual = sorted(s.list_legal_moves())
+        expected = sorted([(0x8, 0x4), (0x8, 0x10), (0x8, 0x400),
+                           (0x8, 0x1000), (0x40000, 0x8 << 32)])
+        self.assertEqual(actual, expected, 'Legal moves in check')
+
+    def test_en_passant_pin(self):
+        # Taking en passant would leave both pawns off the fifth rank and
+        # expose the king to the rook
+        s = State((1 << 38, 0, 0, 0, 0, 1 << 39),
+                  (1 << 37, 0, 0, 1 << 32, 0, 1 << 63),
+                  prev_move=(1 << 53, 1 << 37))
+        self.assertNotIn((1 << 38, 1 << 45), s.list_legal_moves(),
+                         'En passant leaving king in check')
+        s = State((1 << 38, 0, 0, 0, 0, 1 << 39),
+                  (1 << 37, 0, 0, 0, 0, 1 << 63),
+                  prev_move=(1 << 53, 1 << 37))
+        self.assertIn((1 << 38, 1 << 45), s.list_legal_moves(),
+                      'En passant without a pin')
+
+    def test_staged_moves(self):
+        s = State.from_fen('4k3/1P4p1/7p/3q4/4P3/8/3R3Q/4K3 w - - 0 1')
+        moves = list(s.staged_moves())
+        self.assertEqual(sorted(moves), sorted(s.copy().list_legal_moves()),
+                         'Every legal move once')
+        self.assertEqual(moves[:3], [(1 << 27, 1 << 36), (1 << 12, 1 << 36),
+                                     (1 << 54, 1 << 62)],
+                         'Best victim, then cheapest attacker, then promotion')
+        self.assertEqual(moves[-1], (1 << 8, 1 << 40),
+                         'Queen taking a defended pawn comes last')
+        hash_move = (1 << 8, 1 << 16)
+        moves = list(s.staged_moves(hash_move))
+        self.assertEqual(moves[0], hash_move, 'Hash move first')
+        self.assertEqual(moves.count(hash_move), 1, 'Hash move not repeated')
+        self.assertNotIn((1 << 8, 1 << 63), s.staged_moves((1 << 8, 1 << 63)),
+                         'Illegal hash move skipped')
+
+        killer = (1 << 12, 1 << 13)
+        moves = list(s.staged_moves(killers=[killer, (1 << 8, 1 << 36)]))
+        self.assertEqual(moves[3], killer, 'Killer after good captures')
+        self.assertEqual(moves.count(killer), 1, 'Killer not repeated')
+        self.assertEqual(moves.count((1 << 8, 1 << 36)), 0,
+                         'Illegal killer skipped')
+        history = {(1 << 3, 1 << 4): 5, (1 << 8, 1 << 9): 3}
+        moves = list(s.staged_moves(history=history))
+        self.assertEqual(moves[3:5], [(1 << 3, 1 << 4), (1 << 8, 1 << 9)],
+                         'Quiet moves by history score')
+        moves = list(s.staged_moves(mvv_lva=False))
+        self.assertEqual(sorted(moves[:4]), sorted(
+            [(1 << 27, 1 << 36), (1 << 12, 1 << 36), (1 << 54, 1 << 62),
+             (1 << 8, 1 << 40)]),
+            'Captures first but unordered without MVV-LVA')
+
+        # A pinned bishop only moves along the pin, and in check only the
+        # knight's block and the king's step off the file are legal. Black's
+        # own pieces can't be killers for white
+        for fen, legal, illegal in [
+                ('4k3/8/8/8/1b6/8/3B4/4K1N1 w - - 0 1',
+                 [(1 << 12, 1 << 21), (1 << 1, 1 << 18), (1 << 3, 1 << 4)],
+                 [(1 << 12, 1 << 19), (1 << 30, 1 << 21)]),
+                ('k3r3/8/8/8/8/8/8/4K1N1 w - - 0 1',
+                 [(1 << 1, 1 << 11), (1 << 3, 1 << 4)],
+                 [(1 << 1, 1 << 18), (1 << 3, 1 << 11)])]:
+            s = State.from_fen(fen)
+            moves = [move for move in s.staged_moves(killers=legal + illegal)
+                     if not move[1] & s.black_pos]
+            self.assertEqual(moves[:len(legal)], legal,
+                             'Legal killers before quiet moves')
+            for killer in illegal:
+                self.assertNotIn(killer, moves, 'Illegal killer skipped')
+
+    def test_slots(self):
+        s = State()
+        self.assertFalse(hasattr(s, '__dict__'), 'No per-instance dict')
+        self.assertIsNone(s._castle_moves, 'Castle moves created lazily')
+        s = State((0, 0, 0, 1 | 0x80, 0, 0x8), (0, 0, 0, 0, 0, 0x8 << 56))
+        s.list_moves()
+        self.assertEqual(sorted(s.castle_moves), [(0x8, 0x2), (0x8, 0x20)],
+                         'Castle moves recorded by move listing')
+
     def test_eq(self):
         s1 = State()
         s2 = State()
@@ -205,6 +335,61 @@ class StateTest(unittest.TestCase):
         self.assertNotEqual(s1, 21387, 'Not a state')
         self.assertEqual(hash(s1), hash(s2), 'Equals states, hash values')
 
+    def test_zobrist(self):
+        s = State()
+        for move in [(0x2, 0x40000), (0x2 << 56, 0x4 << 40),
+                     (0x40000, 0x2), (0x4 << 40, 0x2 << 56)]:
+            s.make_move(move)
+            self.assertEqual(s.zobrist, s.compute_zobrist(),
+                             'Incremental Zobrist key')
+        self.assertEqual(s.zobrist, State().zobrist, 'Transposition')
+        self.assertNotEqual(State(turn='b').zobrist, State().zobrist,
+                            'Side to move')
+        self.assertNotEqual(State(can_castle=(False, True)).zobrist,
+                            State().zobrist, 'Castling rights')
+
+        s = State.from_fen('4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1')
+        self.assertNotEqual(s.zobrist, State.from_fen(
+            '4k3/8/8/3pP3/8/8/8/4K3 w - - 0 1').zobrist,
+                            'En passant file')
+        s = State.from_fen('4k3/8/8/3p4/8/8/8/4K3 w - d6 0 1')
+        self.assertEqual(s.zobrist, State.from_fen(
+            '4k3/8/8/3p4/8/8/8/4K3 w - - 0 1').zobrist,
+                         'En passant square nobody can capture on')
+
+    def test_psqt(self):
+        self.assertEqual(State().psqt, 0, 'Symmetric start')
+        self.assertGreater(State().get_child(0x800, 0x8000000).psqt, 0,
+                           'Central pawn')
+        # Castling, en passant, promotions and captures with promotion
+        for fen in ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/'
+                    'R3K2R w KQkq - 0 1',
+                    '4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1',
+                    'n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1'):
+            s = State.from_fen(fen)
+            start = s.psqt
+            for move in s.list_legal_moves():
+                for promotion_ix in (1, 4):
+                    undo = s.make_move(move, promotion_ix)
+                    self.assertEqual(s.psqt, s.compute_psqt(),
+                                     'Incremental score')
+                    s.unmake_move(undo)
+                    self.assertEqual(s.psqt, start, 'Score restored')
+
+    def test_null_move(self):
+        s = State.from_fen('4k3/8/8/3pP3/8/8/8/4K2R w K d6 0 1')
+        before = s.copy()
+        undo = s.make_null_move()
+        self.assertFalse(s.white_turn, 'Turn passed')
+        self.assertEqual(s.zobrist, s.compute_zobrist(), 'Zobrist key')
+        self.assertEqual(len(s.list_legal_moves()), 6, 'Black to move')
+        s.unmake_null_move(undo)
+        self.assertEqual(s, before, 'Position restored')
+        self.assertEqual(s.prev_move, before.prev_move, 'Previous move')
+        self.assertIn((1 << 35, 1 << 44), s.list_legal_moves(),
+                      'En passant still possible')
+        self.assertIn((0x8, 0x2), s.list_legal_moves(), 'Castling too')
+
     def test_get_child(self):
         s1 = State()
         s2 = s1.get_child(0x800, 0x80000)
@@ -212,6 +397,31 @@ class StateTest(unittest.TestCase):
         self.assertEqual(s2, expected, 'Pawn Move')
         self.assertRaises(IllegalMoveException, s1.get_child, 0x1, 0x100)
 
+    def test_make_unmake(self):
+        moves = [
+            (State(), (0x800, 0x8000000), 4),
+            (State(wp=0x0800000000, bp=0x1000000000,
+                   prev_move=(1 << 52, 0x1000000000)),
+             (0x0800000000, 1 << 44), 4),
+            (State((0, 0, 0, 1 | 0x80, 0, 0x8), (0, 0, 0, 0, 0, 0x8 << 56)),
+             (0x8, 0x20), 4),
+            (State((0x8 << 48, 0, 0, 0, 0, 0), (0, 0, 0x4 << 56, 0, 0, 0)),
+             (0x8 << 48, 0x4 << 56), 1)
+        ]
+        for state, move, promotion_ix in moves:
+            expected = state.get_child(*move, promotion_ix)
+            before = state.copy()
+            undo = state.make_move(move, promotion_ix)
+            self.assertEqual(state, expected, 'Make move in place')
+            self.assertEqual(state.castles, expected.castles,
+                             'Castling rights after make move')
+            state.unmake_move(undo)
+            self.assertEqual(state, before, 'Unmake move')
+            self.assertEqual(
+                (state.white_pos, state.black_pos, state.prev_move),
+                (before.white_pos, before.black_pos, before.prev_move),
+                'Unmake move restores occupancy')
+
     def test_get_child_pin(self):
         s = State((0, 0, 0, 0, 0x200, 0x1), (0, 0, 0, 0, 1 << 63, 0x80))
         actual = s.get_child(0x200, 0x40000)
@@ -275,6 +485,22 @@ class StateTest(unittest.TestCase):
         self.assertRaises(IllegalStateException, State.from_dict, pieces + [0],
                           'w', False, (True, True), None)
 
+    def test_from_fen(self):
+        actual = State.from_fen(
+            'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
+        self.assertEqual(actual, State(), 'Starting position from FEN')
+
+        actual = State.from_fen('4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1')
+        self.assertEqual(actual.prev_move, (1 << 52, 1 << 36),
+                         'En passant square from FEN')
+        self.assertEqual(actual.castles, (False, False), 'No castling')
+        self.assertIn((1 << 35, 1 << 44), actual.list_legal_moves(),
+                      'En passant after FEN')
+
+        actual = State.from_fen('4k3/8/8/8/8/8/8/4K2r w - - 0 1')
+        self.assertTrue(actual.in_check, 'Check from FEN')
+        self.assertRaises(IllegalStateException, State.from_fen, '8/8 x')
+
     def test_to_dict(self):
         # Test the to_dict method (with knowledge that from_dict is correct
         expected = State()
@@ -0,0 +1,62 @@
+import unittest
+
+from chess.transposition import *
+
+
+class TranspositionTableTest(unittest.TestCase):
+    def test_store_probe(self):
+        table = TranspositionTable(1)
+        self.assertIsNone(table.probe(12345), 'Empty table')
+        table.store(12345, 3, EXACT, 1.5, (1, 2))
+        self.assertEqual(table.probe(12345)[:5], (12345, 3, EXACT, 1.5, (1, 2)),
+                         'Stored entry')
+        self.assertIsNone(table.probe(12345 + table.n_buckets),
+                          'Same slot, different position')
+        self.assertEqual(len(table), 1, 'One entry')
+        table.store(12345, 1, UPPER, 0.5, None)
+        self.assertEqual(table.probe(12345)[MOVE], (1, 2),
+                         'Best move kept for the same position')
+        table.clear()
+        self.assertIsNone(table.probe(12345), 'Cleared')
+
+    def test_size(self):
+        small = TranspositionTable(1)
+        large = TranspositionTable(4)
+        self.assertEqual(large.n_slots // small.n_slots, 4, 'Scales with MB')
+        self.assertLessEqual(small.n_slots * ENTRY_BYTES, 2 ** 20, 'Capped')
+
+    def test_always(self):
+        table = TranspositionTable(1, ALWAYS)
+        other = 7 + table.n_buckets
+        table.store(7, 5, EXACT, 1, None)
+        table.store(other, 1, EXACT, 2, None)
+        self.assertIsNone(table.probe(7), 'Deep entry replaced')
+        self.assertIsNotNone(table.probe(other), 'Newest entry kept')
+
+    def test_depth(self):
+        table = TranspositionTable(1, DEPTH)
+        other = 7 + table.n_buckets
+        table.store(7, 5, EXACT, 1, None)
+        table.store(other, 1, EXACT, 2, None)
+        self.assertIsNotNone(table.probe(7), 'Deep entry kept')
+        self.assertIsNone(table.probe(other), 'Shallow entry dropped')
+        table.new_search()
+        table.store(other, 1, EXACT, 2, None)
+        self.assertIsNotNone(table.probe(other), 'Old entries replaced')
+
+    def test_two_tier(self):
+        table = TranspositionTable(1, TWO_TIER)
+        keys = [7 + i * table.n_buckets for i in range(3)]
+        table.store(keys[0], 5, EXACT, 1, None)
+        table.store(keys[1], 1, EXACT, 2, None)
+        self.assertIsNotNone(table.probe(keys[0]), 'Deep entry kept')
+        self.assertIsNotNone(table.probe(keys[1]), 'Shallow entry kept too')
+        table.store(keys[2], 6, EXACT, 3, None)
+        self.assertIsNotNone(table.probe(keys[2]), 'Deeper entry stored')
+        self.assertIsNotNone(table.probe(keys[0]), 'Replaced entry demoted')
+        self.assertIsNone(table.probe(keys[1]), 'Always replace slot reused')
+        self.assertEqual(len(table), 2, 'Two slots per bucket')
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            TranspositionTable(1, 'lru')